@@ -3,12 +3,16 @@
 
 from __future__ import print_function, unicode_literals
 
+import atexit
 import json
 import logging
 import re
+import signal
 import sys
 import time
 import traceback
+from collections import deque
+from concurrent.futures import Future
 
 import requests
 import telebot
@@ -16,16 +20,29 @@ from emoji import emojize
 
 from yt2audiobot import settings
 from yt2audiobot import dbmanager
+from yt2audiobot import httpsessions
 from yt2audiobot.models import Admin
 from yt2audiobot.models import AudioDBController
 from yt2audiobot.models import AuthorizedUser
+from yt2audiobot.models import RoleCache
 from yt2audiobot.models import Root
 from yt2audiobot.models import TelegramUser
 from yt2audiobot.models import UserAlreadyException
+from yt2audiobot.models import WriteBehindBuffer
+from yt2audiobot.jobqueue import DownloadJobQueue
+from yt2audiobot.jobqueue import InFlightRegistry
 from yt2audiobot.ythelper import DownloadError
 from yt2audiobot.ythelper import FileIsTooLargeException
+from yt2audiobot.ythelper import VideoIsTooLongException
 from yt2audiobot.ythelper import YTHelper
+from yt2audiobot.ythelper import youtube_id_from_url
+from yt2audiobot.progressreporter import ProgressReporter
+from yt2audiobot.storage import StorageManager
+from yt2audiobot.ratelimiter import OutboundScheduler
+from yt2audiobot.ratelimiter import PRIORITY_AUDIO
+from yt2audiobot.ratelimiter import PRIORITY_MESSAGE
 from yt2audiobot.spotifyhelper import Spotify
+from yt2audiobot.workerpool import ChatOrderedWorkerPool
 
 
 logger = logging.getLogger(settings.BOT_NAME)
@@ -43,13 +60,17 @@ MESSAGE_YOU_HAVE_BEEN_BANNED = emojize(
 
 
 class ExceptionCatcherTeleBot(telebot.TeleBot, object):
-    def __init__(self, token, threaded=True, skip_pending=False):
+    def __init__(self, token, threaded=True, skip_pending=False, num_threads=settings.WORKER_POOL_SIZE):
         self.exception_handler = None
-        if threaded:
-            # TODO: make ExceptionCatcherTeleBot works with threaded = True
-            raise RuntimeError('ExceptionCatcherTeleBot can works only with threaded = false by now. '
-                               'Future updates will come!')
-        super(ExceptionCatcherTeleBot, self).__init__(token, threaded=threaded, skip_pending=skip_pending)
+        # the telebot.util.ThreadPool is not created at all: it shares a single queue between all the chats
+        # so the updates of the same chat could be handled out of order. It's replaced by ChatOrderedWorkerPool
+        super(ExceptionCatcherTeleBot, self).__init__(token, threaded=False, skip_pending=skip_pending)
+        self.threaded = threaded
+        if self.threaded:
+            self.worker_pool = ChatOrderedWorkerPool(num_threads)
+        self.outbound_scheduler = OutboundScheduler()
+        # every call to the telegram api goes through the pooled keep-alive connections
+        telebot.apihelper.req_session = httpsessions.SessionProxy('telegram')
     
     
     def set_exception_handler(self, exception_handler):
@@ -65,17 +86,75 @@ class ExceptionCatcherTeleBot(telebot.TeleBot, object):
         super(ExceptionCatcherTeleBot, self).polling(none_stop=none_stop, interval=interval, timeout=timeout)
     
     
+    # all the calls sending something to the users go through the outbound scheduler. The priority can be
+    # overridden by the callers with the 'priority' keyword argument
+    
+    def _schedule(self, chat_id, default_priority, method, *args, **kwargs):
+        priority = kwargs.pop('priority', default_priority)
+        return self.outbound_scheduler.call(chat_id, priority, method, *args, **kwargs)
+    
+    
+    def send_message(self, chat_id, *args, **kwargs):
+        return self._schedule(chat_id, PRIORITY_MESSAGE, super(ExceptionCatcherTeleBot, self).send_message,
+                              chat_id, *args, **kwargs)
+    
+    
+    def forward_message(self, chat_id, *args, **kwargs):
+        return self._schedule(chat_id, PRIORITY_MESSAGE, super(ExceptionCatcherTeleBot, self).forward_message,
+                              chat_id, *args, **kwargs)
+    
+    
+    def send_audio(self, chat_id, *args, **kwargs):
+        return self._schedule(chat_id, PRIORITY_AUDIO, super(ExceptionCatcherTeleBot, self).send_audio,
+                              chat_id, *args, **kwargs)
+    
+    
+    def send_chat_action(self, chat_id, *args, **kwargs):
+        # the chat actions are not messages: they don't use the tokens of the chat
+        return self._schedule(None, PRIORITY_AUDIO, super(ExceptionCatcherTeleBot, self).send_chat_action,
+                              chat_id, *args, **kwargs)
+    
+    
+    def edit_message_text(self, text, chat_id=None, *args, **kwargs):
+        return self._schedule(chat_id, PRIORITY_MESSAGE, super(ExceptionCatcherTeleBot, self).edit_message_text,
+                              text, chat_id, *args, **kwargs)
+    
+    
+    def edit_message_reply_markup(self, chat_id=None, *args, **kwargs):
+        return self._schedule(chat_id, PRIORITY_MESSAGE,
+                              super(ExceptionCatcherTeleBot, self).edit_message_reply_markup, chat_id, *args, **kwargs)
+    
+    
+    def answer_callback_query(self, *args, **kwargs):
+        return self._schedule(None, PRIORITY_MESSAGE, super(ExceptionCatcherTeleBot, self).answer_callback_query,
+                              *args, **kwargs)
+    
+    
+    @staticmethod
+    def _get_chat_key(update):
+        # messages have the chat, callback queries have the message (if it is not inline) or the user at least
+        if hasattr(update, 'chat'):
+            return update.chat.id
+        if getattr(update, 'message', None) is not None:
+            return update.message.chat.id
+        return update.from_user.id
+    
+    
     def _exec_task(self, task, *args, **kwargs):
         if self.threaded:
-            self.worker_pool.put(task, *args, **kwargs)
+            # args[0] contains the message
+            self.worker_pool.put(self._get_chat_key(args[0]), self._exec_task_catching_exception,
+                                 task, *args, **kwargs)
         else:
+            self._exec_task_catching_exception(task, *args, **kwargs)
     
-            logger.debug(len(args))
-            try:
-                task(*args, **kwargs)
-            except Exception as e:
-                # args[0] contains the message
-                self.exception_handler(args[0], traceback.format_exc())
+    
+    def _exec_task_catching_exception(self, task, *args, **kwargs):
+        try:
+            task(*args, **kwargs)
+        except Exception as e:
+            # args[0] contains the message
+            self.exception_handler(args[0], traceback.format_exc())
 
 
 class ParseException(Exception):
@@ -120,17 +199,33 @@ def start_bot():
     
     root_commands = {  # command description used in the 'help' command
         'addAdmin': 'Create a new authorized admin from telegram id or username.\n' + \
-                    'Example:\n/addAdmin username or\n/addAdmin 12345678'
+                    'Example:\n/addAdmin username or\n/addAdmin 12345678',
+        'httpStats': 'Shows how many HTTP connections of the bot have been reused'
     }
 
+    # created before any thread and any db connection: its constructor spawns the worker processes, so they are not
+    # forked from a process full of threads or sharing the sqlite connections
+    job_queue = DownloadJobQueue()
     dbmanager.connect_to_db(
         settings.ABS_PATH_USERS_DB,
         settings.BOT_SECRETS['yt2audiobot_root']
     )
     audio_db = AudioDBController()
+    write_behind = WriteBehindBuffer()
+    # the buffered updates are written however the bot exits: SIGTERM exits too, so that the atexit handlers run
+    # (in reverse order: the download processes are stopped first, then the progress messages are sent)
+    atexit.register(write_behind.stop)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    role_cache = RoleCache()
+    in_flight = InFlightRegistry()
+    storage = StorageManager()
+    storage.sweep()
     
     bot = ExceptionCatcherTeleBot(settings.BOT_SECRETS['telegram_token'],
-                                  threaded=False)  # in the future maybe will be threaded
+                                  threaded=True, num_threads=settings.WORKER_POOL_SIZE)
+    progress_reporter = ProgressReporter(bot)
+    atexit.register(progress_reporter.stop)
+    atexit.register(job_queue.shutdown, wait=False)
     bot_me = bot.get_me()
     logger.info(bot_me)
     
@@ -142,14 +237,17 @@ def start_bot():
                                             (h['downloaded_times'], 'time' if h['downloaded_times'] == 1 else 'times'),
             'downloading': lambda h: '[%s] Downloading at %s' % (h['_percent_str'], h['_speed_str']),
             'finished': lambda h: 'Download finished: %s\nStart extracting audio postprocess..' % h['_total_bytes_str'],
+            'waiting_same_video': lambda h: 'This video is already being downloaded for someone else, '
+                                            'you will get it as soon as it is ready',
+            'playlist_progress': lambda h: '%d/%d done, %d downloading' % (h['done'], h['total'], h['downloading']),
             'searching_metadata': lambda h: 'Searching audio metadata from Spotify and Musixmatch',
             'upload_audio': lambda h: 'Uploading...',
             'done': lambda h: emojize('Done! :white_heavy_check_mark:')
         }
         
         
-        def __init__(self, bot, chat_id, message_id):
-            self._bot = bot
+        def __init__(self, progress_reporter, chat_id, message_id):
+            self._progress_reporter = progress_reporter
             self._chat_id = chat_id
             self._message_id = message_id
             self._count = 0
@@ -171,8 +269,8 @@ def start_bot():
                 
                 text += self.STATUS_TO_MESSAGE[hook['status']](hook)
                 
-                self._bot.edit_message_text(text, self._chat_id, self._message_id, disable_web_page_preview=True)
-                # self._bot.send_message(self._chat_id, text, disable_web_page_preview=True)
+                # the youtube_dl hooks come several times per second: the progress reporter throttles the edits
+                self._progress_reporter.update(self._chat_id, self._message_id, text, final=hook['status'] == 'done')
             except KeyError as e:
                 root_chat_ids = Root.get_root_chat_id()
                 for chat_id in root_chat_ids:
@@ -203,7 +301,22 @@ def start_bot():
     
     def update_admin_user(m):
         if m.chat.type == 'private':
-            Admin.from_telegram_user(m.from_user, chat_id=m.chat.id, dont_raise=True)
+            roles = role_cache.get(m.from_user)
+            if not roles.is_admin:
+                return
+            if roles.admin_profile_matches(m.from_user, m.chat.id):
+                # nothing changed but the last connection: it doesn't need to be written right now
+                write_behind.touch_last_connection(roles.authorized_user_id)
+                return
+            admin = Admin.from_telegram_user(m.from_user, chat_id=m.chat.id, update_db=False, dont_raise=True)
+            if admin is None:
+                return
+            if admin.is_dirty() or admin.authorized_user.is_dirty():
+                admin.save()
+                admin.authorized_user.save()
+                role_cache.invalidate(telegram_id=m.from_user.id)
+            else:
+                write_behind.touch_last_connection(admin.authorized_user.id)
     
     
     def username_or_telegram_id(text):
@@ -223,51 +336,258 @@ def start_bot():
             'ID Accepted characters: A-z (case-insensitive), 0-9 and underscores.Length: 5-32 characters.')
     
     
+    class YoutubeRequest(object):
+        # All the videos of a youtube link: one video or a whole playlist. At most settings.PLAYLIST_CONCURRENCY
+        # videos are downloaded at the same time and the audios are delivered in the playlist order.
+        # Every method runs in the worker of the chat, so the state doesn't need any lock.
+        
+        def __init__(self, m, yth_progress_hook, ytvideos):
+            self._m = m
+            self._cid = m.chat.id
+            self._yth_progress_hook = yth_progress_hook
+            self._ytvideos = ytvideos
+            self._is_playlist = len(ytvideos) > 1
+            self._pending = deque()
+            self._downloading = set()
+            self._results = { }  # index -> result not delivered yet
+            self._next_to_deliver = 0
+        
+        
+        def run_in_chat_worker(self, func, *args):
+            # the first argument of the tasks is the message: it chooses the worker and it's given to manage_exception
+            bot._exec_task(lambda m: func(*args), self._m)
+        
+        
+        def _progress_hook(self, hook, youtube_video=None):
+            # the progress of every single video is shown only if the request is not a playlist
+            if not self._is_playlist:
+                self._yth_progress_hook.get_progress_hook()(hook, youtube_video=youtube_video)
+        
+        
+        def _notify_playlist_progress(self):
+            if self._is_playlist:
+                self._yth_progress_hook.notify_progress({
+                    'status': 'playlist_progress',
+                    'done': self._next_to_deliver + len(self._results),
+                    'downloading': len(self._downloading),
+                    'total': len(self._ytvideos)
+                })
+        
+        
+        def start(self):
+            # one query for all the videos: the cached ones are delivered at once, only the others are downloaded
+            cached = audio_db.search_by_youtube_ids([ytvideo.get_youtube_id() for ytvideo in self._ytvideos])
+            for index, ytvideo in enumerate(self._ytvideos):
+                if ytvideo.get_youtube_id() in cached:
+                    yt2tg_mapping, _ = cached[ytvideo.get_youtube_id()]
+                    self._results[index] = ('cached', yt2tg_mapping)
+                else:
+                    self._pending.append(index)
+            self._schedule()
+            self._deliver_ready()
+        
+        
+        def _schedule(self):
+            while len(self._downloading) < settings.PLAYLIST_CONCURRENCY and len(self._pending) > 0:
+                index = self._pending.popleft()
+                self._downloading.add(index)
+                self._start_download(index)
+        
+        
+        def _start_download(self, index):
+            ytvideo = self._ytvideos[index]
+            youtube_id = ytvideo.get_youtube_id()
+            if not in_flight.acquire(youtube_id, self._progress_hook, (self, index)):
+                # the leader will hand the result over with on_ready
+                self._progress_hook({
+                    'status': 'waiting_same_video'
+                })
+                return
+            
+            try:
+                # the video could have been uploaded between the search and the acquire
+                yt2tg_mapping, _ = audio_db.search_by_youtube_or_telegram_file(youtube_id=youtube_id)
+                if yt2tg_mapping:
+                    release_followers(youtube_id, yt2tg_mapping.telegram_file_id, None)
+                    self._downloading.discard(index)
+                    self._results[index] = ('cached', yt2tg_mapping)
+                    return
+                
+                # downloaded but not uploaded (i.e. the upload failed): the audio is still in the hot tier
+                data = storage.hot(youtube_id)
+                if data is not None:
+                    logger.info('[Storage] %s uploaded from the hot tier', youtube_id)
+                    future = Future()
+                    future.set_result(data)
+                    self._downloading.discard(index)
+                    self._results[index] = ('downloaded', future)
+                    return
+                
+                def job_progress_hook(hook, youtube_video=None):
+                    self._progress_hook(hook, youtube_video=youtube_video)
+                    in_flight.notify_progress(youtube_id, hook, youtube_video=youtube_video)
+                
+                def on_job_done(future):
+                    self.run_in_chat_worker(self.on_ready, index, ('downloaded', future))
+                
+                job_queue.submit(ytvideo, job_progress_hook, on_job_done, enrich=not settings.FAST_DELIVERY)
+            except Exception as e:
+                # youtube_id must not stay in flight without a leader: the followers get an error now, this chat
+                # when the failed download is delivered
+                logger.error(traceback.format_exc())
+                release_followers(youtube_id, None, None)
+                future = Future()
+                future.set_exception(e)
+                self._downloading.discard(index)
+                self._results[index] = ('downloaded', future)
+        
+        
+        def on_ready(self, index, result):
+            self._downloading.discard(index)
+            self._results[index] = result
+            self._schedule()
+            self._deliver_ready()
+        
+        
+        def _deliver_ready(self):
+            while self._next_to_deliver in self._results:
+                index = self._next_to_deliver
+                try:
+                    self._deliver(self._ytvideos[index], self._results[index])
+                except Exception:
+                    # the other audios of the request must be delivered anyway
+                    bot.exception_handler(self._m, traceback.format_exc())
+                finally:
+                    del self._results[index]
+                    self._next_to_deliver += 1
+            
+            if self._next_to_deliver == len(self._ytvideos):
+                self._yth_progress_hook.notify_progress({
+                    'status': 'done'
+                })
+            else:
+                self._notify_playlist_progress()
+        
+        
+        def _deliver(self, ytvideo, result):
+            if result[0] == 'cached':
+                yt2tg_mapping = result[1]
+                self._progress_hook({
+                    'status': 'already_downloaded',
+                    'downloaded_times': yt2tg_mapping.downloaded_times
+                })
+                send_cached_audio(self._cid, yt2tg_mapping)
+            elif result[0] == 'shared':
+                telegram_file_id, error_text = result[1], result[2]
+                if telegram_file_id is not None:
+                    bot.send_audio(self._cid, telegram_file_id, caption='Downloaded using @yt2audiobot')
+                    write_behind.increment_downloaded_times(ytvideo.get_youtube_id())
+                else:
+                    if error_text is None:
+                        error_text = emojize('Oooops! Something went wrong! :face_with_cold_sweat:')
+                    bot.send_message(self._cid, error_text, disable_web_page_preview=True)
+            else:
+                self._upload(ytvideo, result[1])
+        
+        
+        def _upload(self, ytvideo, future):
+            youtube_id = ytvideo.get_youtube_id()
+            telegram_file_id = None
+            error_text = None
+            data = None
+            try:
+                data = future.result()
+                self._progress_hook({
+                    'status': 'upload_audio'
+                })
+                in_flight.notify_progress(youtube_id, {
+                    'status': 'upload_audio'
+                }, youtube_video=ytvideo)
+                bot.send_chat_action(self._cid, 'upload_audio')
+                with open(data['filename'], 'rb') as audio:
+                    # not tagged yet (FAST_DELIVERY): telegram shows the title given here
+                    audio_message = bot.send_audio(self._cid, audio, caption='Downloaded using @yt2audiobot',
+                                                   title=data['title'], performer=data['author']).audio
+                data['youtube_id'] = youtube_id
+                data['telegram_file_id'] = audio_message.file_id
+                data['file_size'] = audio_message.file_size
+                data['duration'] = audio_message.duration
+                audio_db.add_youtube_telegram_file_entry_and_metadata(**data)
+                telegram_file_id = audio_message.file_id
+                if not data['enriched']:
+                    enrich_later(ytvideo)
+            except DownloadError as e:
+                logger.error('[Download Error] %s', e)
+                error_text = str(e)
+                bot.send_message(self._cid, error_text)
+            except FileIsTooLargeException as e:
+                logger.error('[File Is Too Large] %s', e)
+                error_text = str(e)
+                bot.send_message(self._cid, error_text, disable_web_page_preview=True)
+            except VideoIsTooLongException as e:
+                logger.error('[Video Is Too Long] %s', e)
+                error_text = str(e)
+                bot.send_message(self._cid, error_text, disable_web_page_preview=True)
+            finally:
+                if data is None:
+                    storage.discard(youtube_id)
+                else:
+                    storage.keep(youtube_id, data)
+                # the requests of the same video arrived in the meanwhile get the uploaded file, without downloading it
+                release_followers(youtube_id, telegram_file_id, error_text)
+    
+    
+    def enrich_later(ytvideo):
+        # the audio has already been sent untagged: its metadata are searched in background and stored in the db
+        youtube_id = ytvideo.get_youtube_id()
+        
+        def on_enriched(future):
+            try:
+                audio_db.update_metadata(youtube_id, **future.result())
+                logger.info('[Enrichment] %s done', youtube_id)
+            except Exception as e:
+                logger.error('[Enrichment] %s failed: %s', youtube_id, e)
+        
+        job_queue.submit_metadata_search(ytvideo, on_enriched)
+    
+    
+    def release_followers(youtube_id, telegram_file_id, error_text):
+        for follower_request, follower_index in in_flight.release(youtube_id):
+            follower_request.run_in_chat_worker(follower_request.on_ready, follower_index,
+                                                ('shared', telegram_file_id, error_text))
+    
+    
+    def send_cached_audio(cid, yt2tg_mapping):
+        bot.send_audio(cid, yt2tg_mapping.telegram_file_id, caption='Downloaded using @yt2audiobot')
+        write_behind.increment_downloaded_times(yt2tg_mapping.youtube_id)
+    
+    
     def handle_youtube_link(m):
         cid = m.chat.id
         r = re.search(YOUTUBE_REGEX, m.text)
         if r is not None:
             youtube_url = r.group(0)
             reply_message = bot.reply_to(m, 'Managing your request...')
-            yth_progress_hook = YTHelperProgressHook(bot, cid, reply_message.message_id)
-            yt_helper = YTHelper(youtube_url, yth_progress_hook.get_progress_hook())
+            yth_progress_hook = YTHelperProgressHook(progress_reporter, cid, reply_message.message_id)
             
-            for ytvideo in yt_helper.manage_url():
-                youtube_id = ytvideo.get_youtube_id()
+            # fast path: a single video already uploaded doesn't need any request to youtube
+            youtube_id = youtube_id_from_url(youtube_url)
+            if youtube_id is not None:
                 yt2tg_mapping, _ = audio_db.search_by_youtube_or_telegram_file(youtube_id=youtube_id)
-                
                 if yt2tg_mapping:
                     yth_progress_hook.notify_progress({
                         'status': 'already_downloaded',
                         'downloaded_times': yt2tg_mapping.downloaded_times
                     })
-                    bot.send_audio(cid, yt2tg_mapping.telegram_file_id, caption='Downloaded using @yt2audiobot')
-                    yt2tg_mapping.downloaded_times += 1
-                    yt2tg_mapping.save()
-                else:
-                    try:
-                        data = ytvideo.download_video_and_extract_audio()
-                        audio = open(data['filename'], 'rb')
-                        yth_progress_hook.notify_progress({
-                            'status': 'upload_audio'
-                        })
-                        bot.send_chat_action(cid, 'upload_audio')
-                        audio_message = bot.send_audio(cid, audio, caption='Downloaded using @yt2audiobot').audio
-                        data['youtube_id'] = youtube_id
-                        data['telegram_file_id'] = audio_message.file_id
-                        data['file_size'] = audio_message.file_size
-                        data['duration'] = audio_message.duration
-                        audio_db.add_youtube_telegram_file_entry_and_metadata(**data)
-                    except DownloadError as e:
-                        logger.error('[Download Error] %s', e)
-                        bot.send_message(cid, str(e))
-                    except FileIsTooLargeException as e:
-                        logger.error('[File Is Too Large] %s', e)
-                        bot.send_message(cid, str(e), disable_web_page_preview=True)
+                    send_cached_audio(cid, yt2tg_mapping)
+                    yth_progress_hook.notify_progress({
+                        'status': 'done'
+                    })
+                    return
             
-            yth_progress_hook.notify_progress({
-                'status': 'done'
-            })
+            yt_helper = YTHelper(youtube_url, yth_progress_hook.get_progress_hook())
+            # the download jobs only get enqueued: the audios are sent as soon as the jobs are finished
+            YoutubeRequest(m, yth_progress_hook, list(yt_helper.manage_url())).start()
         
         else:
             bot.send_message(cid, 'Sorry, it is not a valid youtube link!')
@@ -289,6 +609,7 @@ def start_bot():
         msg = bot.send_message(root_cid, emojize(
             'Going to downgrade the Admin: {0} :smirking_face:\n'.format(admin_user)))
         deleted_rows = admin_user.delete_instance()
+        role_cache.invalidate(telegram_id=auth_user.telegram_id, username=auth_user.username)
         bot.edit_message_text(emojize(
             'Done! Downgraded successfully for user: {0} :thumbs_up_sign: \n'
             '(deleted rows: {1})'.format(auth_user, deleted_rows)), root_cid, msg.message_id)
@@ -302,6 +623,7 @@ def start_bot():
                 tg_user = username_or_telegram_id(text)
                 try:
                     class_type.create_from_telegram_user(tg_user, blocked=False, access_requested_count=0)
+                    role_cache.invalidate(telegram_id=tg_user.id, username=tg_user.username)
                     bot.send_message(cid, emojize('Done! :thumb_up_sign:'))
                 except UserAlreadyException as e:
                     bot.send_message(cid, emojize('{0}.. :neutral_face:'.format(e)))
@@ -318,14 +640,15 @@ def start_bot():
     def handle_help(m):
         cid = m.chat.id
         update_admin_user(m)
-        if AuthorizedUser.is_authorized_from_telegram_user(m.from_user):
+        roles = role_cache.get(m.from_user)
+        if roles.is_authorized:
             help_text = 'The following commands are available: \n'
             for key in user_commands:
                 help_text += '/%s: %s\n' % (key, user_commands[key])
-            if Admin.exists_from_telegram_user(m.from_user):
+            if roles.is_admin:
                 for key in admin_commands:
                     help_text += '/%s: %s\n' % (key, admin_commands[key])
-                if Root.exists_from_telegram_user(m.from_user):
+                if roles.is_root:
                     for key in root_commands:
                         help_text += '/%s: %s\n' % (key, root_commands[key])
             
@@ -373,7 +696,7 @@ def start_bot():
         cid = callback_data['cid']
         mid = callback_data['mid']
         
-        if AuthorizedUser.is_banned_from_telegram_user(call.from_user):
+        if role_cache.get(call.from_user).is_banned:
             start_text = MESSAGE_YOU_HAVE_BEEN_BANNED
             markup = telebot.types.InlineKeyboardMarkup()
             markup.add(telebot.types.InlineKeyboardButton('Github', url=settings.URL_REPO_GITHUB))
@@ -423,6 +746,7 @@ def start_bot():
                 blocked=True,
                 access_requested_count=1
             )
+        role_cache.invalidate(telegram_id=call.from_user.id)
     
     
     @bot.callback_query_handler(func=lambda call: json.loads(call.data)['act'] == 'agree_user')
@@ -438,7 +762,7 @@ def start_bot():
         tg_user = TelegramUser(user_cid, None, None, None)
         
         # check if the user who press the button is root and make sure that the target is not the root
-        if Root.exists_from_telegram_user(call.from_user) and not Root.exists_from_telegram_user(tg_user):
+        if role_cache.get(call.from_user).is_root and not role_cache.get(tg_user).is_root:
             
             try:
                 # if the user doesn't exist it will raise an exception.
@@ -469,6 +793,7 @@ def start_bot():
                     auth_user.blocked = False
                     auth_user.access_requested_count = 0
                     auth_user.save()
+                    role_cache.invalidate(telegram_id=user_cid)
                 
                 elif callback_data['act'] in ['deny_user', 'ban_user']:
                     if admin_user is not None:
@@ -481,6 +806,7 @@ def start_bot():
                     
                     bot.send_message(root_cid, emojize('Done! :thumbs_up_sign:'))
                     auth_user.save()
+                    role_cache.invalidate(telegram_id=user_cid)
                 else:
                     raise Exception('Action unknown: {0}'.format(callback_data['act']))
                 
@@ -494,7 +820,7 @@ def start_bot():
             except AuthorizedUser.DoesNotExist as e:
                 bot.send_message(root_cid, emojize('{0}.. :neutral_face:'.format(e)))
         
-        elif not Root.exists_from_telegram_user(call.from_user):
+        elif not role_cache.get(call.from_user).is_root:
             bot.send_message(call.message.chat.id, 'This command can only be used by admin users')
             root_chat_ids = Root.get_root_chat_id()
             for chat_id in root_chat_ids:
@@ -505,7 +831,7 @@ def start_bot():
     
     @bot.message_handler(commands=['addUser', 'adduser'])
     def handle_add_user(m):
-        if Admin.exists_from_telegram_user(m.from_user):
+        if role_cache.get(m.from_user).is_admin:
             add_user_from_type(m, AuthorizedUser)
         else:
             bot.send_message(m.chat.id, 'This command can be used only by admin users')
@@ -514,16 +840,25 @@ def start_bot():
     @bot.message_handler(commands=['addAdmin', 'addadmin'])
     def handle_add_admin(m):
         cid = m.chat.id
-        if Root.exists_from_telegram_user(m.from_user):
+        if role_cache.get(m.from_user).is_root:
             update_admin_user(m)
             add_user_from_type(m, Admin)
         else:
             bot.send_message(cid, 'This command can be used only by root user')
     
     
+    @bot.message_handler(commands=['httpStats', 'httpstats'])
+    def handle_http_stats(m):
+        cid = m.chat.id
+        if role_cache.get(m.from_user).is_root:
+            bot.send_message(cid, httpsessions.format_stats())
+        else:
+            bot.send_message(cid, 'This command can be used only by root user')
+    
+    
     @bot.message_handler(regexp=YOUTUBE_REGEX, func=lambda m: m.chat.type == 'private')
     def handle_youtube_link_regex(m):
-        if AuthorizedUser.is_authorized_from_telegram_user(m.from_user):
+        if role_cache.get(m.from_user).is_authorized:
             update_admin_user(m)
             handle_youtube_link(m)
     
@@ -533,7 +868,7 @@ def start_bot():
     
     @bot.message_handler(commands=get_mp3_commands_array)
     def handle_youtube_link_commands(m):
-        if AuthorizedUser.is_authorized_from_telegram_user(m.from_user):
+        if role_cache.get(m.from_user).is_authorized:
             update_admin_user(m)
             if '@' + bot_me.username in m.text:
                 m.text = m.text.replace('@' + bot_me.username, '')
@@ -558,7 +893,7 @@ def start_bot():
             logger.error(traceback.format_exc())
             for chat_id in Root.get_root_chat_id():
                 bot.send_message(chat_id, str(traceback.format_exc()))
-            exit(1)
+            exit(1)  # the atexit handlers stop the download processes and write what is buffered
 
 
 if __name__ == '__main__':
@@ -580,10 +915,13 @@ if __name__ == '__main__':
                     settings.ABS_PATH_USERS_DB,
                     settings.BOT_SECRETS['yt2audiobot_root']
                 )
+            elif len(sys.argv) == 3 and sys.argv[1] == 'importmetadata':
+                dbmanager.import_metadata(sys.argv[2])
             else:
                 logger.error('Invalid argument(s): %s!\n'
-                             'Please simply run the bot without any argument or '
-                             'initialize the db with \'createdb\'' % sys.argv[1:], file=sys.stderr)
+                             'Please simply run the bot without any argument, '
+                             'initialize the db with \'createdb\' or fill the metadata index with '
+                             '\'importmetadata <audiodb|dump.jsonl>\'' % sys.argv[1:], file=sys.stderr)
     
     except IOError as e:
         logger.error(e)
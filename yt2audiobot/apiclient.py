@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import time
+import logging
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+from yt2audiobot import settings
+from yt2audiobot.ratelimiter import TokenBucket
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+
+class ProviderThrottledException(Exception):
+    # raised by the calls of a provider when it asks to slow down
+    def __init__(self, message, retry_after):
+        super(ProviderThrottledException, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class ProviderUnavailableException(Exception):
+    pass
+
+
+def parse_retry_after(value, default=1):
+    # the seconds of a Retry-After header: either a number of seconds or an HTTP date, the default if it's neither
+    if value is None:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    date = parsedate_tz(value)
+    if date is None:
+        logger.warning('Invalid Retry-After: %s', value)
+        return default
+    return max(0, int(mktime_tz(date) - time.time()))
+
+
+class CircuitBreaker(object):
+    # closed: the calls are allowed. After `failure_threshold` consecutive failures it opens and the calls are
+    # rejected for `reset_timeout` seconds, then a single trial call is allowed (half open): it closes the
+    # circuit if it succeeds, otherwise the circuit opens again.
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = None
+        self._trial_running = False
+
+
+    def allow(self):
+        with self._lock:
+            if self._open_until is None:
+                return True
+            if time.time() < self._open_until or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._open_until = None
+            self._trial_running = False
+
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self._failure_threshold:
+                self._open(self._reset_timeout)
+
+
+    def open_for(self, seconds):
+        with self._lock:
+            self._open(seconds)
+
+
+    def _open(self, seconds):
+        self._open_until = max(self._open_until or 0, time.time() + seconds)
+        self._trial_running = False
+
+
+    def is_open(self):
+        with self._lock:
+            return self._open_until is not None and time.time() < self._open_until
+
+
+class ProviderClient(object):
+    # Every call to the api of a provider (musixmatch, spotify) goes through its client: the calls are paced by a
+    # token bucket, the throttled calls are retried after the Retry-After (the longer throttles open the circuit
+    # instead of waiting) and the provider is skipped while its circuit breaker is open.
+    # The api is called by the download processes, each with its own client: rate and burst are shared among them.
+
+    def __init__(self, name, rate, burst=settings.PROVIDER_BURST, max_retries=settings.PROVIDER_MAX_RETRIES,
+                 max_retry_after=settings.PROVIDER_MAX_RETRY_AFTER,
+                 failure_threshold=settings.PROVIDER_FAILURE_THRESHOLD, reset_timeout=settings.PROVIDER_RESET_TIMEOUT,
+                 processes=settings.JOB_PROCESS_POOL_SIZE):
+        self.name = name
+        self._bucket = TokenBucket(float(rate) / processes, max(1.0, float(burst) / processes))
+        self._breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._max_retries = max_retries
+        self._max_retry_after = max_retry_after
+        self._lock = threading.Lock()
+        self._counters = dict((key, 0) for key in ['calls', 'throttles', 'failures', 'rejected'])
+        with _clients_lock:
+            _clients[name] = self
+
+
+    def _count(self, key):
+        with self._lock:
+            self._counters[key] += 1
+
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+    def call(self, func, *args, **kwargs):
+        retries = 0
+        while True:
+            # the retries of a call already allowed are not checked again: the trial call of the half open circuit
+            # must be resolved by its own outcome
+            if retries == 0 and not self._breaker.allow():
+                self._count('rejected')
+                raise ProviderUnavailableException('%s is skipped: it is failing or throttled' % self.name)
+            self._bucket.acquire()
+            self._count('calls')
+            try:
+                result = func(*args, **kwargs)
+            except ProviderThrottledException as e:
+                self._count('throttles')
+                if e.retry_after > self._max_retry_after or retries >= self._max_retries:
+                    logger.warning('[%s] throttled for %s seconds: skipped in the meantime', self.name, e.retry_after)
+                    self._breaker.open_for(e.retry_after)
+                    raise
+                retries += 1
+                logger.warning('[%s] throttled: retry after %s seconds (%d/%d)',
+                               self.name, e.retry_after, retries, self._max_retries)
+                self._bucket.pause(e.retry_after)
+                continue
+            except Exception:
+                self._count('failures')
+                self._breaker.record_failure()
+                raise
+            self._breaker.record_success()
+            return result
+
+
+_clients_lock = threading.Lock()
+_clients = { }
+
+
+def format_stats():
+    with _clients_lock:
+        clients = sorted(_clients.items())
+    lines = []
+    for name, client in clients:
+        counters = client.counters()
+        lines.append('%s: %d calls, %d throttles, %d failures, %d rejected%s' %
+                     (name, counters['calls'], counters['throttles'], counters['failures'], counters['rejected'],
+                      ' (circuit open)' if client._breaker.is_open() else ''))
+    return '\n'.join(lines)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import logging
+
+import mutagen
+
+from yt2audiobot import settings
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+
+ENCODE = 'encode'
+ORIGINAL = 'original'
+
+
+class AudioOutput(object):
+    # how the audio of a video is served: codec is the preferredcodec of FFmpegExtractAudio and the extension of
+    # the file, bitrate (kbps) its preferredquality. A passthrough output is only remuxed by ffmpeg, never encoded
+
+    def __init__(self, codec, bitrate, passthrough=False):
+        self.codec = codec
+        self.bitrate = bitrate
+        self.passthrough = passthrough
+
+
+    def __repr__(self):
+        return '<AudioOutput: %s %skbps%s>' % (self.codec, self.bitrate, ' passthrough' if self.passthrough else '')
+
+
+def audio_format_selector(policy=None):
+    # the youtube_dl format: with the original policy the audio streams that can be passed through are preferred
+    if (policy or settings.AUDIO_CODEC_POLICY) == ORIGINAL:
+        return '/'.join(['bestaudio[ext=%s]' % ext for ext in settings.PASSTHROUGH_AUDIO_FORMATS] + ['bestaudio/best'])
+    return 'bestaudio/best'
+
+
+def passthrough_output(audio_format, policy=None):
+    # the output serving the audio format (a youtube_dl format dict) as it is, None if it has to be encoded
+    if (policy or settings.AUDIO_CODEC_POLICY) != ORIGINAL:
+        return None
+    ext = audio_format.get('ext', None)
+    if audio_format.get('vcodec', None) != 'none' or ext not in settings.PASSTHROUGH_AUDIO_FORMATS:
+        return None
+    abr = audio_format.get('abr', None)
+    return AudioOutput(ext, int(abr) if abr else None, passthrough=True)
+
+
+def encoded_output(bitrate):
+    return AudioOutput(settings.PREFERRED_AUDIO_CODEC, bitrate)
+
+
+def probe(filename):
+    # (codec, bitrate in kbps) of the file actually served, (None, None) if mutagen cannot read it
+    try:
+        audiofile = mutagen.File(filename)
+    except Exception as e:
+        logger.warning('Cannot probe %s: %s', filename, e)
+        return None, None
+    if audiofile is None:
+        return None, None
+    info = audiofile.info
+    codec = getattr(info, 'codec', None) or type(audiofile).__name__.lower()
+    if codec.startswith('mp4a'):
+        codec = 'aac'
+    bitrate = int(round(info.bitrate / 1000.0)) if getattr(info, 'bitrate', None) else None
+    return codec, bitrate
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import os
+import errno
+import hashlib
+import logging
+import tempfile
+import subprocess
+
+import requests
+
+from yt2audiobot import utils
+from yt2audiobot import settings
+from yt2audiobot import httpsessions
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+
+# mjpeg qualities tried (best first) until the cover fits COVER_MAX_BYTES
+JPEG_QUALITIES = [2, 4, 6, 9, 13, 18, 25, 31]
+# the eviction frees the disk down to this fraction of the budget, so the next ones aren't needed right away
+EVICTION_LOW_WATERMARK = 0.9
+
+
+class Cover(object):
+    def __init__(self, url, data, mimetype):
+        self.url = url
+        self.data = data
+        self.mimetype = mimetype
+
+
+def _sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _write_atomically(path, data):
+    # the cache is shared by the download processes: a file is either missing or complete
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(temp_path, path)
+
+
+def shrink_cover(data, max_dimension, max_bytes):
+    # scales the image down (never up) to max_dimension and encodes it as a jpeg of at most max_bytes (the best
+    # quality fitting, the worst one if none fits). Returns None if ffmpeg cannot read it
+    scale = ("scale=w='min(iw,{0})':h='min(ih,{0})':force_original_aspect_ratio=decrease".format(max_dimension))
+    shrunk = None
+    for quality in JPEG_QUALITIES:
+        command = ['ffmpeg', '-loglevel', 'error', '-f', 'image2pipe', '-i', 'pipe:0', '-vf', scale,
+                   '-q:v', str(quality), '-frames:v', '1', '-f', 'image2pipe', '-vcodec', 'mjpeg', 'pipe:1']
+        try:
+            ffmpeg = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            logger.warning('Cannot run ffmpeg to shrink the cover: %s', e)
+            return None
+        output, error = ffmpeg.communicate(data)
+        if ffmpeg.returncode != 0 or len(output) == 0:
+            logger.warning('Cannot shrink the cover: %s', error.decode('utf-8', 'replace').strip())
+            return None
+        shrunk = output
+        if len(shrunk) <= max_bytes:
+            break
+    return shrunk
+
+
+class CoverCache(object):
+    # Content addressed cache of the covers on disk, shared by the download processes:
+    #   <directory>/<sha1 of the original image>.jpg  the cover shrunk by shrink_cover
+    #   <directory>/urls/<sha1 of the url>            the sha1 of the image downloaded from the url
+    # The same image downloaded from different urls is shrunk and stored once. A hit touches the file, the least
+    # recently used covers are evicted when the directory exceeds the disk budget. The directory is scanned only
+    # when the size known by the process (the one of the last scan plus the covers it has stored since) exceeds the
+    # budget; the urls of the evicted covers are removed when they are requested again.
+
+    def __init__(self, directory=settings.COVER_CACHE_DIR, max_dimension=settings.COVER_MAX_DIMENSION,
+                 max_bytes=settings.COVER_MAX_BYTES, disk_budget=settings.COVER_CACHE_DISK_BUDGET):
+        self._directory = directory
+        self._urls_directory = os.path.join(directory, 'urls')
+        self._max_dimension = max_dimension
+        self._max_bytes = max_bytes
+        self._disk_budget = disk_budget
+        self._size = None  # bytes of the covers at the last scan, plus the ones stored since by this process
+
+
+    def _ensure_directories(self):
+        for directory in [self._directory, self._urls_directory]:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+
+    def _cover_path(self, key):
+        return os.path.join(self._directory, key + '.jpg')
+
+
+    def _url_path(self, url):
+        return os.path.join(self._urls_directory, _sha1(url.encode('utf-8')))
+
+
+    def _read(self, key):
+        path = self._cover_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+            return data
+        except (IOError, OSError):
+            return None
+
+
+    def get(self, url):
+        # the cover of the image at url, downloaded and shrunk only if it isn't cached. None if it cannot be
+        # downloaded
+        self._ensure_directories()
+        url_path = self._url_path(url)
+        try:
+            with open(url_path, 'rb') as f:
+                data = self._read(f.read().decode('ascii'))
+            if data is not None:
+                return Cover(url, data, 'image/jpeg')
+            os.remove(url_path)  # its cover has been evicted
+        except (IOError, OSError):
+            pass
+
+        try:
+            r = httpsessions.get_session('thumbnails').get(url)
+        except requests.RequestException as e:
+            logger.warning('Cannot download the cover %s: %s', url, e)
+            return None
+        if r.status_code != 200:
+            logger.warning('Cannot download the cover %s: HTTP %d', url, r.status_code)
+            return None
+        key = _sha1(r.content)
+        data = self._read(key)
+        if data is None:
+            data = shrink_cover(r.content, self._max_dimension, self._max_bytes)
+            if data is None:
+                # not cached: it will be tried again the next time
+                return Cover(url, r.content, r.headers.get('Content-Type', 'image/jpeg'))
+            logger.debug('Cover %s: %s shrunk to %s', url, utils.format_size(len(r.content)),
+                         utils.format_size(len(data)))
+            _write_atomically(self._cover_path(key), data)
+            if self._size is None or self._size + len(data) > self._disk_budget:
+                self.evict()
+            else:
+                self._size += len(data)
+        _write_atomically(url_path, key.encode('ascii'))
+        return Cover(url, data, 'image/jpeg')
+
+
+    def evict(self):
+        # scans the directory: when it exceeds the disk budget, the least recently used covers are evicted down to
+        # EVICTION_LOW_WATERMARK of the budget. The covers can be evicted by another process at the same time
+        covers = []
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if name.endswith('.jpg'):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                covers.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in covers)
+        if total > self._disk_budget:
+            for _, size, path in sorted(covers):
+                if total <= self._disk_budget * EVICTION_LOW_WATERMARK:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+        self._size = total
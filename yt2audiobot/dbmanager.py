@@ -3,8 +3,11 @@
 
 from __future__ import unicode_literals
 
+import io
+import json
 import peewee
 import logging
+from datetime import datetime
 from six.moves import input
 from playhouse.migrate import migrate
 from playhouse.migrate import SqliteMigrator
@@ -16,6 +19,9 @@ from yt2audiobot.models import get_database
 from yt2audiobot.models import AuthorizedUser
 from yt2audiobot.models import Admin
 from yt2audiobot.models import Root
+from yt2audiobot.models import AudioMetadata
+from yt2audiobot.models import MetadataIndex
+from yt2audiobot.metadatahelper import CACHE_DATETIME_FORMAT
 
 
 logger = logging.getLogger(settings.BOT_NAME)
@@ -149,4 +155,66 @@ def initialize_db(path, root_username):
             exit(1)
     
     _initialize_root(predicate, root_username)
-    _verify_migrations(db)
\ No newline at end of file
+    _verify_migrations(db)
+
+
+def _parse_release_date(value):
+    if not value:
+        return None
+    for date_format in [CACHE_DATETIME_FORMAT, '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d', '%Y']:
+        try:
+            return datetime.strptime(value, date_format).strftime(CACHE_DATETIME_FORMAT)
+        except ValueError:
+            pass
+    logger.warning('Unknown release date format: %s', value)
+    return None
+
+
+def _songs_from_audio_db(path):
+    AudioMetadata._meta.database.init(path)
+    for metadata in AudioMetadata.select().iterator():
+        yield {
+            'title': metadata.title,
+            'author': metadata.author,
+            'album': metadata.album,
+            'track_number': metadata.track_number,
+            'first_release_date': metadata.first_release_date.strftime(CACHE_DATETIME_FORMAT)
+            if metadata.first_release_date is not None else None
+        }
+
+
+def _songs_from_dump(path):
+    # one json object per line with the keys: title, author, album, track_number and first_release_date
+    with io.open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                song = json.loads(line)
+            except ValueError as e:
+                logger.warning('%s:%d skipped: %s', path, line_number, e)
+                continue
+            song['first_release_date'] = _parse_release_date(song.get('first_release_date', None))
+            yield song
+
+
+def import_metadata(source, batch_size=1000):
+    # fills the local metadata index with the metadata of the audios already sent ('audiodb')
+    # or with a catalog dump (json lines)
+    if source == 'audiodb':
+        songs = _songs_from_audio_db(settings.ABS_PATH_AUDIO_DB)
+    else:
+        songs = _songs_from_dump(source)
+    
+    index = MetadataIndex()
+    batch = []
+    imported = 0
+    for song in songs:
+        batch.append(song)
+        if len(batch) == batch_size:
+            imported += index.add_many(batch)
+            batch = []
+    imported += index.add_many(batch)
+    logger.info('%d songs imported in the metadata index from %s', imported, source)
+    return imported
+
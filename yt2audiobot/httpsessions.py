@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import os
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from yt2audiobot import settings
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+
+# name -> (pool size, default timeout)
+SESSIONS = {
+    'telegram': (settings.HTTP_TELEGRAM_POOL_SIZE, None),  # apihelper always gives its own timeouts
+    'musixmatch': (settings.HTTP_POOL_SIZE, settings.HTTP_TIMEOUT),
+    'spotify': (settings.HTTP_POOL_SIZE, settings.HTTP_TIMEOUT),
+    'thumbnails': (settings.HTTP_POOL_SIZE, settings.HTTP_TIMEOUT),
+    'youtube': (settings.HTTP_POOL_SIZE, settings.HTTP_TIMEOUT),  # the audio streams, see streampipeline
+}
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    # keeps the connections alive in a pool of `pool_size` connections per host, retries the connection errors
+    # (and the 5xx of the idempotent requests) and uses `timeout` when the request doesn't give one
+
+    def __init__(self, pool_size, timeout=None, max_retries=settings.HTTP_MAX_RETRIES):
+        self._timeout = timeout
+        self._stats_lock = threading.Lock()
+        self._closed_requests = 0  # sent by the pools already closed
+        self._closed_connections = 0
+        retry = Retry(total=max_retries, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504],
+                      raise_on_status=False)
+        super(PooledHTTPAdapter, self).__init__(pool_connections=pool_size, pool_maxsize=pool_size,
+                                                max_retries=retry)
+
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        # the pools closed (by close or evicted by the pool manager) keep counting in the stats
+        dispose = self.poolmanager.pools.dispose_func
+
+        def dispose_and_count(pool):
+            with self._stats_lock:
+                self._closed_requests += pool.num_requests
+                self._closed_connections += pool.num_connections
+            dispose(pool)
+
+        self.poolmanager.pools.dispose_func = dispose_and_count
+
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout', None) is None:
+            kwargs['timeout'] = self._timeout
+        return super(PooledHTTPAdapter, self).send(request, **kwargs)
+
+
+    def stats(self):
+        # requests sent and connections opened by the pools, the closed ones included
+        pools = self.poolmanager.pools
+        with self._stats_lock:
+            requests_count, connections_count = self._closed_requests, self._closed_connections
+        for key in pools.keys():
+            pool = pools.get(key, None)
+            if pool is not None:
+                requests_count += pool.num_requests
+                connections_count += pool.num_connections
+        return requests_count, connections_count
+
+
+_lock = threading.Lock()
+_sessions = { }
+_sessions_pid = None
+
+
+def get_session(name):
+    # the sessions of the current process: the download processes never reuse the sockets of the bot process
+    global _sessions_pid
+    with _lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        session = _sessions.get(name, None)
+        if session is None:
+            pool_size, timeout = SESSIONS[name]
+            adapter = PooledHTTPAdapter(pool_size, timeout)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[name] = session
+        return session
+
+
+class SessionProxy(requests.Session):
+    # for the libraries keeping a session forever (telebot, spotipy): every request goes through the session
+    # of the process making it
+
+    def __init__(self, name):
+        super(SessionProxy, self).__init__()
+        self._name = name
+
+
+    def request(self, *args, **kwargs):
+        return get_session(self._name).request(*args, **kwargs)
+
+
+def stats():
+    # name -> (requests, new connections, reused connections) of the sessions of the current process
+    with _lock:
+        sessions = dict(_sessions) if _sessions_pid == os.getpid() else { }
+    result = { }
+    for name, session in sessions.items():
+        requests_count, connections_count = session.get_adapter('https://').stats()
+        result[name] = (requests_count, connections_count, requests_count - connections_count)
+    return result
+
+
+def format_stats():
+    lines = []
+    for name, (requests_count, connections_count, reused) in sorted(stats().items()):
+        hit_rate = reused * 100.0 / requests_count if requests_count > 0 else 0
+        lines.append('%s: %d requests, %d connections opened, %d reused (%.1f%%)' %
+                     (name, requests_count, connections_count, reused, hit_rate))
+    return '\n'.join(lines) or 'No HTTP requests yet'
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import os
+import time
+import errno
+import select
+import signal
+import logging
+import itertools
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future
+
+import six
+
+from yt2audiobot import settings
+from yt2audiobot import apiclient
+from yt2audiobot import httpsessions
+from yt2audiobot.ythelper import YoutubeVideo
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+
+# the messages of the workers: (kind, job_id, progress hook / result / exception)
+_PROGRESS = 'progress'
+_DONE = 'done'
+_FAILED = 'failed'
+_STOP = None
+_WATCHDOG_INTERVAL = 1
+
+
+class WorkerDiedException(Exception):
+    pass
+
+
+class JobTimeoutException(Exception):
+    pass
+
+
+class _ConnectionProgressHook(object):
+    # used inside the worker processes: forwards the progress to the bot process
+
+    def __init__(self, send, job_id):
+        self._send = send
+        self._job_id = job_id
+
+
+    def __call__(self, hook, youtube_video=None):
+        # the youtube_dl hooks can contain objects that cannot be pickled: only plain values are sent back
+        hook = dict((k, v) for k, v in hook.items()
+                    if v is None or isinstance(v, six.string_types + six.integer_types + (float, bool)))
+        self._send((_PROGRESS, self._job_id, hook))
+
+
+def _ignore_progress(hook, youtube_video=None):
+    pass
+
+
+def _log_process_stats():
+    logger.debug('HTTP sessions and api clients of the download process %d:\n%s\n%s',
+                 os.getpid(), httpsessions.format_stats(), apiclient.format_stats())
+
+
+def _download_video_and_extract_audio(progress_hook, video_id, info, enrich):
+    ytvideo = YoutubeVideo(video_id, info, progress_hook)
+    try:
+        return ytvideo.download_video_and_extract_audio(enrich=enrich)
+    finally:
+        _log_process_stats()
+
+
+def _search_metadata(progress_hook, video_id, info):
+    ytvideo = YoutubeVideo(video_id, info, _ignore_progress)
+    try:
+        return ytvideo.search_metadata()
+    finally:
+        _log_process_stats()
+
+
+def _exit_with_parent(parent_pid):
+    # a worker is re-parented when the bot dies (i.e. killed with SIGKILL): it must not outlive it
+    while True:
+        time.sleep(_WATCHDOG_INTERVAL)
+        if os.getppid() != parent_pid:
+            os._exit(1)
+
+
+def _worker(conn, parent_pid):
+    # the main loop of a worker process: runs the jobs received on conn, one at a time, and sends back their
+    # progress and their result
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    watchdog = threading.Thread(target=_exit_with_parent, args=(parent_pid,), name='ParentWatchdog')
+    watchdog.daemon = True
+    watchdog.start()
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, IOError):
+            return
+        if task is _STOP:
+            return
+        job_id, func, args = task
+        try:
+            message = (_DONE, job_id, func(_ConnectionProgressHook(send, job_id), *args))
+        except Exception as e:
+            message = (_FAILED, job_id, e)
+        try:
+            send(message)
+        except (EOFError, IOError):
+            return
+        except Exception as e:
+            # the result cannot be pickled
+            send((_FAILED, job_id, Exception('%s: %s' % (type(e).__name__, e))))
+
+
+class _Worker(object):
+    def __init__(self, parent_pid):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_worker, args=(child_conn, parent_pid),
+                                               name='DownloadWorker')
+        self.process.daemon = True
+        self.process.start()
+        # only the worker keeps its end: its death closes the pipe
+        child_conn.close()
+        self.job_id = None  # the job running
+        self.killed = False  # no job is dispatched to a worker being killed
+
+
+class _Job(object):
+    def __init__(self, ytvideo, progress_hook, func, args):
+        self.ytvideo = ytvideo
+        self.progress_hook = progress_hook  # None: the progress is ignored
+        self.func = func
+        self.args = args
+        self.future = Future()
+        self.worker = None
+        self.started_at = None
+
+
+class DownloadJobQueue(object):
+    # Runs YoutubeVideo.download_video_and_extract_audio in a pool of processes, so the CPU heavy audio
+    # extraction doesn't compete with the bot threads. Every worker is connected to the bot by a pipe: it receives
+    # the jobs dispatched to it, one at a time, and streams back their progress and their result. The listener thread
+    # resolves the futures, calls the progress hooks given at submission time and dispatches the queued jobs.
+    # The workers are spawned by the constructor: the DownloadJobQueue is created before any other thread, so they
+    # are not forked from a process holding the locks of other threads. The workers that die are replaced (forked
+    # by the listener thread), their jobs fail, and so do the jobs running for more than JOB_TIMEOUT seconds, whose
+    # worker is killed. The workers exit as soon as the bot dies.
+
+    def __init__(self, max_workers=settings.JOB_PROCESS_POOL_SIZE, timeout=settings.JOB_TIMEOUT):
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self._jobs = { }  # job_id -> _Job, queued or running
+        self._queued = deque()  # job_ids not dispatched yet
+        self._pid = os.getpid()
+        self._workers = [_Worker(self._pid) for _ in range(max_workers)]
+        logger.info('Download processes started: %s', ', '.join(str(w.process.pid) for w in self._workers))
+
+        self._stopped = threading.Event()
+        self._listener = threading.Thread(target=self._run, name='JobListener')
+        self._listener.daemon = True
+        self._listener.start()
+
+
+    def _submit(self, ytvideo, progress_hook, func, *args):
+        job = _Job(ytvideo, progress_hook, func, args)
+        with self._lock:
+            job_id = next(self._job_ids)
+            self._jobs[job_id] = job
+            self._queued.append(job_id)
+        self._dispatch()
+        return job_id, job.future
+
+
+    def submit(self, ytvideo, progress_hook, done_callback, enrich=True):
+        # done_callback(future) is called, from an internal thread, as soon as the job is finished
+        # enrich=False: the audio is not tagged, see submit_metadata_search
+        job_id, future = self._submit(ytvideo, progress_hook, _download_video_and_extract_audio,
+                                      ytvideo.get_youtube_id(), ytvideo.get_info(), enrich)
+        logger.info('Enqueue job %d: %s (%s)', job_id, ytvideo.get_video_title(), ytvideo.get_url())
+        future.add_done_callback(done_callback)
+        return future
+
+
+    def submit_metadata_search(self, ytvideo, done_callback):
+        # searches the metadata of an audio already extracted (and sent), without progress
+        job_id, future = self._submit(ytvideo, None, _search_metadata, ytvideo.get_youtube_id(), ytvideo.get_info())
+        logger.info('Enqueue metadata search %d: %s (%s)', job_id, ytvideo.get_video_title(), ytvideo.get_url())
+        future.add_done_callback(done_callback)
+        return future
+
+
+    def _dispatch(self):
+        # the queued jobs to the idle workers
+        with self._lock:
+            while len(self._queued) > 0 and not self._stopped.is_set():
+                idle_workers = [w for w in self._workers if w.job_id is None and not w.killed]
+                if len(idle_workers) == 0:
+                    return
+                worker = idle_workers[0]
+                job_id = self._queued.popleft()
+                job = self._jobs[job_id]
+                worker.job_id = job_id
+                job.worker = worker
+                job.started_at = time.time()
+                try:
+                    worker.conn.send((job_id, job.func, job.args))
+                except (IOError, OSError) as e:
+                    # the worker is dead: the job fails with it
+                    logger.error('Cannot send job %d to the download process %d: %s', job_id, worker.process.pid, e)
+
+
+    def _finish(self, job_id, result=None, exception=None):
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+            if job is not None and job.worker is not None and job.worker.job_id == job_id:
+                job.worker.job_id = None
+        if job is None:
+            # already failed (i.e. timed out)
+            return
+        if exception is not None:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(result)
+
+
+    def _progress(self, job_id, hook):
+        with self._lock:
+            job = self._jobs.get(job_id, None)
+        if job is None or job.progress_hook is None:
+            # the job is already finished, the progress is not relevant anymore
+            return
+        try:
+            job.progress_hook(hook, youtube_video=job.ytvideo)
+        except Exception as e:
+            logger.error('Progress hook of job %d failed: %s', job_id, e)
+
+
+    def _replace(self, worker):
+        worker.conn.close()
+        worker.process.join()
+        with self._lock:
+            job_id = worker.job_id
+            self._workers.remove(worker)
+        if job_id is not None:
+            logger.error('Job %d failed: the download process %d died (exit code %s)',
+                         job_id, worker.process.pid, worker.process.exitcode)
+            self._finish(job_id, exception=WorkerDiedException('the download process %d died' % worker.process.pid))
+        if self._stopped.is_set():
+            return
+        new_worker = _Worker(self._pid)
+        logger.info('Download process %d replaced by %d', worker.process.pid, new_worker.process.pid)
+        with self._lock:
+            self._workers.append(new_worker)
+
+
+    def _check_timeouts(self):
+        now = time.time()
+        with self._lock:
+            expired = [(job_id, job.worker) for job_id, job in self._jobs.items()
+                       if job.worker is not None and now - job.started_at > self._timeout]
+        for job_id, worker in expired:
+            # the job fails now, its worker is replaced as soon as it's dead
+            logger.error('Job %d is running for more than %d seconds: killing %d',
+                         job_id, self._timeout, worker.process.pid)
+            worker.killed = True
+            try:
+                os.kill(worker.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self._finish(job_id, exception=JobTimeoutException('the job has taken more than %ds' % self._timeout))
+
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                workers = list(self._workers)
+            try:
+                readable, _, _ = select.select([w.conn for w in workers], [], [], _WATCHDOG_INTERVAL)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for worker in workers:
+                if worker.conn not in readable:
+                    continue
+                try:
+                    kind, job_id, value = worker.conn.recv()
+                except (EOFError, IOError):
+                    # the worker died, is_alive below replaces it
+                    worker.process.join(_WATCHDOG_INTERVAL)
+                    continue
+                if kind == _PROGRESS:
+                    self._progress(job_id, value)
+                elif kind == _DONE:
+                    self._finish(job_id, result=value)
+                else:
+                    self._finish(job_id, exception=value)
+            try:
+                # a killed worker could still have its pipe open (i.e. in the ffmpeg it was running)
+                for worker in workers:
+                    if not worker.process.is_alive():
+                        self._replace(worker)
+                self._check_timeouts()
+                self._dispatch()
+            except Exception as e:
+                logger.error('Job listener failed: %s', e)
+
+
+    def shutdown(self, wait=True):
+        # wait=False: the running jobs are interrupted
+        self._stopped.set()
+        self._listener.join()
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            try:
+                worker.conn.send(_STOP)
+            except (IOError, OSError):
+                pass
+            if not wait:
+                worker.process.terminate()
+        for worker in workers:
+            worker.process.join()
+
+
+class InFlightRegistry(object):
+    # Keeps track of the videos being downloaded and uploaded. The first request of a youtube_id is the leader
+    # and runs the job, the following ones attach to it: they receive the progress of the running job on their
+    # own progress hook and are handed back to the leader (release) when the job is finished.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = { }  # youtube_id -> list of (progress_hook, follower)
+
+
+    def acquire(self, youtube_id, progress_hook, follower):
+        # returns True if the caller is the leader, otherwise the follower has been attached to the running job
+        with self._lock:
+            followers = self._in_flight.get(youtube_id, None)
+            if followers is None:
+                self._in_flight[youtube_id] = []
+                return True
+            followers.append((progress_hook, follower))
+            return False
+
+
+    def notify_progress(self, youtube_id, hook, youtube_video=None):
+        with self._lock:
+            progress_hooks = [progress_hook for progress_hook, _ in self._in_flight.get(youtube_id, [])]
+        for progress_hook in progress_hooks:
+            try:
+                progress_hook(hook, youtube_video=youtube_video)
+            except Exception as e:
+                logger.error('Progress hook of a follower of %s failed: %s', youtube_id, e)
+
+
+    def release(self, youtube_id):
+        # returns the followers attached while the job was running
+        with self._lock:
+            followers = self._in_flight.pop(youtube_id, [])
+        return [follower for _, follower in followers]
@@ -1,18 +1,37 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from __future__ import unicode_literals, absolute_import
+from __future__ import print_function, unicode_literals, absolute_import
 
 import re
+import time
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
-from mutagen.mp3 import MP3, EasyMP3
-from mutagen.id3 import error, PictureType
-from mutagen.id3._frames import APIC
+from mutagen.mp4 import MP4, MP4Cover
+from mutagen.id3 import ID3, ID3NoHeaderError, PictureType
+from mutagen.id3 import TIT2, TPE1, TALB, TRCK, TDRC, APIC
 
 from yt2audiobot import utils
 from yt2audiobot import settings
 from yt2audiobot import musixmatch
+from yt2audiobot.models import metadataindex
+from yt2audiobot.models.metadatacache import MetadataCache
+from yt2audiobot.models.metadataindex import MetadataIndex
 from yt2audiobot.spotifyhelper import Spotify
+from yt2audiobot.titlematcher import TitleMatcher
+from yt2audiobot.titlematcher import remove_bad_words
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+CACHE_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+ID3_PADDING = 4096
+_cache = MetadataCache()
+_index = MetadataIndex()
+# the threads are started by the first resolution, so only in the processes resolving the metadata
+_executor = ThreadPoolExecutor(max_workers=settings.METADATA_RESOLVER_THREADS)
 
 
 class SongMetadata(object):
@@ -52,29 +71,118 @@ class SongMetadata(object):
         return utils.get_valid_filename(self.__str__(printalbum=False))
 
 
-def remove_bad_word(text):
-    for word in settings.BAD_WORDS:
-        text = text.replace(word, '')
-    return text
+def normalize_title(title):
+    return ' '.join(title.lower().split())
+
+
+def index_query_tokens(orig_title):
+    # the words of the title without the ones inside parenthesis and the bad words
+    title = re.sub('\\(.*?\\)|\\[.*?\\]', '', orig_title)
+    return metadataindex.tokenize(title) - metadataindex.tokenize(' '.join(settings.BAD_WORDS))
+
+
+def _cached(namespace, query, fetch, cacheable=lambda value: True):
+    value = _cache.get(namespace, query)
+    if value is MetadataCache.MISS:
+        value = fetch()
+        if cacheable(value):
+            _cache.set(namespace, query, value)
+    return value
+
 
+def _request_tracks(track_ids):
+    # the tracks found in the cache, the others with a batched request
+    tracks = { }
+    for track_id in track_ids:
+        track = _cache.get('spotify.track', track_id)
+        if track is not MetadataCache.MISS:
+            tracks[track_id] = track
+    missing = [track_id for track_id in track_ids if track_id not in tracks]
+    if len(missing) > 0:
+        for track_id, track in Spotify.request_tracks(missing).items():
+            if track is not None:
+                _cache.set('spotify.track', track_id, track)
+            tracks[track_id] = track
+    return tracks
 
-# thanks to: http://stackoverflow.com/a/5320179
-def find_whole_word(w, text):
-    return re.compile(r'\b({0})\b'.format(w), flags=re.IGNORECASE).search(text)
+
+def _metadata_to_cache(metadata):
+    data = dict((key, getattr(metadata, key)) for key in SongMetadata.keys)
+    if data['first_release_date'] is not None:
+        data['first_release_date'] = data['first_release_date'].strftime(CACHE_DATETIME_FORMAT)
+    return data
+
+
+def _metadata_from_cache(data):
+    data = dict(data)
+    if data['first_release_date'] is not None:
+        data['first_release_date'] = datetime.strptime(data['first_release_date'], CACHE_DATETIME_FORMAT)
+    return SongMetadata(data)
+
+
+def _wait_result(future, deadline, what):
+    # returns (True, result) or (False, None) if the future failed or didn't finish before the deadline
+    try:
+        return True, future.result(timeout=max(0, deadline - time.time()))
+    except TimeoutError:
+        logger.warning('%s: no answer before the deadline', what)
+    except Exception as e:
+        logger.warning('%s failed: %s', what, e)
+    return False, None
 
 
-def search_in_text(word_list, text):
-    for w in word_list:
-        if find_whole_word(w, text):
-            return True
-    return False
+def _resolve_metadata(title, matcher):
+    # musixmatch and spotify are searched at the same time, the musixmatch result has precedence.
+    # Returns (metadata or None, complete): complete is False if a source failed or didn't answer in time,
+    # so a None result cannot be trusted (cached)
+    deadline = time.time() + settings.METADATA_RESOLUTION_TIMEOUT
+    mxm_future = _executor.submit(_cached, 'musixmatch.track.search', title,
+                                  lambda: musixmatch.track_search_raw(title), musixmatch.is_successful)
+    spotify_future = _executor.submit(_cached, 'spotify.search', title, lambda: Spotify.search(title))
+    complete = True
+    
+    ok, raw_result = _wait_result(mxm_future, deadline, 'musixmatch search of "%s"' % title)
+    track_list = musixmatch.Message.de_json(raw_result).track_list if ok else None
+    if track_list is None:
+        complete = False
+    candidates = [r for r in track_list or [] if r.track_rating > 75 and r.track_spotify_id]
+    tracks_future = None
+    if len(candidates) > 0:
+        # the track numbers of all the candidates of the page with one request
+        tracks_future = _executor.submit(_request_tracks, [r.track_spotify_id for r in candidates])
+    for r in candidates:
+        if matcher.matches_all(r.track_name, r.artist_name):
+            ok, tracks = _wait_result(tracks_future, deadline, 'spotify tracks of "%s"' % title)
+            track = tracks.get(r.track_spotify_id, None) if ok else None
+            data = {
+                'title': r.track_name,
+                'author': r.artist_name,
+                'album': r.album_name,
+                'track_number': track['track_number'] if track is not None else 0,
+                'first_release_date': r.first_release_date
+            }
+            return SongMetadata(data), True
+    
+    ok, results = _wait_result(spotify_future, deadline, 'spotify search of "%s"' % title)
+    if not ok:
+        return None, False
+    for r in results:
+        if matcher.matches_all(r['title'], ' '.join(r['artists'])):
+            data = {
+                'title': r['title'],
+                'author': ' - '.join(r['artists']),
+                'album': r['album'],
+                'track_number': r['track_number']
+            }
+            return SongMetadata(data), True
+    return None, complete
 
 
 def metadata_from_title(orig_title):
     # remove substing inside parenthesis..
     title = re.sub('\(.*?\)', '', orig_title)
     title = re.sub('\[.*?\]', '', title)
-    title = remove_bad_word(title)
+    title = remove_bad_words(title)
     
     title_words = title.split(' ')
     try:
@@ -82,64 +190,149 @@ def metadata_from_title(orig_title):
     except Exception as e:
         pass
     
-    result = musixmatch.track_search(title)
-    for r in result.track_list:
-        if r.track_rating > 75:
-            if search_in_text(title_words, r.track_name) and search_in_text(title_words, r.artist_name):
-                track_number = 0
-                if r.track_spotify_id:
-                    try:
-                        track_number = Spotify.request_track(r.track_spotify_id)['track_number']
-                    except:
-                        pass
-                    data = {
-                        'title': r.track_name,
-                        'author': r.artist_name,
-                        'album': r.album_name,
-                        'track_number': track_number,
-                        'first_release_date': r.first_release_date
-                    }
-                    return SongMetadata(data)
-    
-    results = Spotify.search(title)
-    for r in results:
-        if search_in_text(title_words, r['title']) and search_in_text(title_words, ' '.join(r['artists'])):
-            data = {
-                'title': r['title'],
-                'author': ' - '.join(r['artists']),
-                'album': r['album'],
-                'track_number': r['track_number']
-            }
-            return SongMetadata(data)
+    # the titles that cannot be resolved are cached as None
+    key = normalize_title(title)
+    data = _cache.get('metadata', key)
+    if data is MetadataCache.MISS:
+        data, score = _index.search(index_query_tokens(orig_title))
+        if data is not None:
+            logger.info('Metadata of "%s" found in the local index (score: %.2f)', key, score)
+            metadata = _metadata_from_cache(data)
+            _cache.set('metadata', key, data)
+        else:
+            metadata, complete = _resolve_metadata(title, TitleMatcher(title_words))
+            if metadata is not None:
+                _cache.set('metadata', key, _metadata_to_cache(metadata))
+                _index.add(_metadata_to_cache(metadata))
+            elif complete:
+                _cache.set('metadata', key, None)
+    else:
+        logger.info('Metadata of "%s" found in cache', key)
+        metadata = _metadata_from_cache(data) if data is not None else None
+    
+    if metadata is not None:
+        return metadata
     data = {
         'title': orig_title
     }
     return SongMetadata(data)
 
 
-def write_metadata(metadata, mp3_file, thumbnail):
-    audiofile = EasyMP3(mp3_file)
-    try:
+def write_metadata(metadata, audio_file, thumbnail):
+    # the passthrough audios (see codecpolicy) are m4a, the encoded ones mp3
+    if audio_file.endswith('.m4a'):
+        write_mp4_metadata(metadata, audio_file, thumbnail)
+    else:
+        write_mp3_metadata(metadata, audio_file, thumbnail)
+
+
+def write_mp4_metadata(metadata, m4a_file, thumbnail):
+    audiofile = MP4(m4a_file)
+    if audiofile.tags is None:
         audiofile.add_tags()
-    except error:
-        pass
     
-    audiofile['title'] = metadata.title
+    audiofile['\xa9nam'] = metadata.title
     if metadata.author:
-        audiofile['artist'] = metadata.author
+        audiofile['\xa9ART'] = metadata.author
     if metadata.album:
-        audiofile['album'] = metadata.album
+        audiofile['\xa9alb'] = metadata.album
     if metadata.track_number != 0:
-        audiofile['tracknumber'] = str(metadata.track_number)
+        audiofile['trkn'] = [(metadata.track_number, 0)]
     if metadata.first_release_date:
-        audiofile['date'] = str(metadata.first_release_date)
+        audiofile['\xa9day'] = str(metadata.first_release_date)
+    if thumbnail is not None:
+        imageformat = MP4Cover.FORMAT_PNG if thumbnail.mimetype == 'image/png' else MP4Cover.FORMAT_JPEG
+        audiofile['covr'] = [MP4Cover(thumbnail.data, imageformat=imageformat)]
     audiofile.save()
+
+
+def _id3_padding(info):
+    # the tags are rewritten in place when they fit, otherwise the audio is moved once leaving some room for a later
+    # rewrite (i.e. the enrichment of FAST_DELIVERY)
+    return info.padding if info.padding >= 0 else ID3_PADDING
+
+
+def write_mp3_metadata(metadata, mp3_file, thumbnail):
+    # all the frames, cover included, are built in memory and written with a single save: the audio is moved only
+    # if the new tags don't fit in the space of the old ones
+    try:
+        tags = ID3(mp3_file)
+    except ID3NoHeaderError:
+        tags = ID3()
     
+    tags.add(TIT2(encoding=3, text=metadata.title))
+    if metadata.author:
+        tags.add(TPE1(encoding=3, text=metadata.author))
+    if metadata.album:
+        tags.add(TALB(encoding=3, text=metadata.album))
+    if metadata.track_number != 0:
+        tags.add(TRCK(encoding=3, text=str(metadata.track_number)))
+    if metadata.first_release_date:
+        tags.add(TDRC(encoding=3, text=str(metadata.first_release_date)))
     if thumbnail is not None:
+        tags.add(APIC(encoding=3,
+                      mime=thumbnail.mimetype,
+                      type=PictureType.COVER_FRONT,
+                      desc=u'Cover Front',
+                      data=thumbnail.data))
+    tags.save(mp3_file, padding=_id3_padding)
+
+
+if __name__ == '__main__':
+    # benchmark of write_mp3_metadata against the previous double save (EasyMP3 for the text frames, then MP3 for
+    # the cover read back from the temporary file of the thumbnail) on untagged mp3s of growing size
+    import os
+    import shutil
+    import tempfile
+    from mutagen.mp3 import MP3, EasyMP3
+    
+    class Thumbnail(object):
+        def __init__(self, filename, data):
+            self.filename = filename
+            self.data = data
+            self.mimetype = 'image/jpeg'
+    
+    def double_save(metadata, mp3_file, thumbnail):
+        audiofile = EasyMP3(mp3_file)
+        audiofile.add_tags()
+        audiofile['title'] = metadata.title
+        audiofile['artist'] = metadata.author
+        audiofile['album'] = metadata.album
+        audiofile['tracknumber'] = str(metadata.track_number)
+        audiofile.save()
         audiofile = MP3(mp3_file)
-        audiofile.tags.add(APIC(encoding=3,
-                                mime=thumbnail.mimetype,
-                                type=PictureType.COVER_FRONT,
-                                desc=u'Cover Front',
-                                data=open(thumbnail.filename).read()))
-    audiofile.save()
+        audiofile.tags.add(APIC(encoding=3, mime=thumbnail.mimetype, type=PictureType.COVER_FRONT,
+                                desc=u'Cover Front', data=open(thumbnail.filename, 'rb').read()))
+        audiofile.save()
+    
+    def bench(write, source, metadata, thumbnail, number=5):
+        elapsed = 0.0
+        for _ in range(number):
+            target = source + '.tagged'
+            shutil.copyfile(source, target)
+            start = time.time()
+            write(metadata, target, thumbnail)
+            elapsed += time.time() - start
+        return elapsed / number
+    
+    directory = tempfile.mkdtemp()
+    try:
+        # silent MPEG-1 layer III frames (128kbps, 44100Hz) and a 200 KiB cover
+        frame = b'\xff\xfb\x90\x64' + b'\x00' * 413
+        cover = os.urandom(200 << 10)
+        thumbnail = Thumbnail(os.path.join(directory, 'thumb'), cover)
+        with open(thumbnail.filename, 'wb') as f:
+            f.write(cover)
+        metadata = SongMetadata({'title': 'Believer', 'author': 'Imagine Dragons', 'album': 'Evolve',
+                                 'track_number': 3, 'first_release_date': None})
+        
+        for size_mb in [5, 20, 50]:
+            source = os.path.join(directory, '%dmb.mp3' % size_mb)
+            with open(source, 'wb') as f:
+                f.write(frame * ((size_mb << 20) // len(frame)))
+            double_save_time = bench(double_save, source, metadata, thumbnail)
+            single_save_time = bench(write_mp3_metadata, source, metadata, thumbnail)
+            print('%3d MB: double save %6.1f ms, single save %6.1f ms (x%.1f)' %
+                  (size_mb, double_save_time * 1000, single_save_time * 1000, double_save_time / single_save_time))
+    finally:
+        shutil.rmtree(directory)
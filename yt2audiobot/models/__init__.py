@@ -13,10 +13,15 @@ from .admin import Admin
 from .root import Root
 from .usersutils import TelegramUser
 from .usersutils import UserAlreadyException
+from .writebehind import WriteBehindBuffer
+from .rolecache import RoleCache
+from .metadatacache import MetadataCache
+from .metadataindex import MetadataIndex
 
 __all__ = ('TelegramUser', 'UserAlreadyException',
            'BaseModel', 'get_database',
            'AuthorizedUser', 'Admin', 'Root',
            'YoutubeToTelegramFile', 'AudioMetadata',
+           'WriteBehindBuffer', 'RoleCache', 'MetadataCache', 'MetadataIndex',
            # TODO: Remove asap
            'AudioDBController')
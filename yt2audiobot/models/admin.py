@@ -4,6 +4,7 @@
 from __future__ import unicode_literals
 
 import logging
+import threading
 from playhouse.migrate import *
 
 from yt2audiobot import settings
@@ -38,9 +39,37 @@ class Admin(BaseModel):
                'chat_id:{chat_id}'.format(auth_user=self.authorized_user, chat_id=self.chat_id)
     
     
+    # incremented whenever an admin (or a root) is created, changed or deleted: the in-memory snapshots of the
+    # admins compare it to know when they need to be reloaded
+    _changes = 0
+    _changes_lock = threading.Lock()
+    
+    
+    @classmethod
+    def notify_changed(cls):
+        with cls._changes_lock:
+            Admin._changes += 1
+    
+    
+    @classmethod
+    def get_changes_count(cls):
+        return Admin._changes
+    
+    
+    def save(self, *args, **kwargs):
+        changed = self.is_dirty()
+        result = super(Admin, self).save(*args, **kwargs)
+        if changed:
+            self.notify_changed()
+        return result
+    
+    
     def delete_instance(self, recursive=False, delete_nullable=False):
         logger.warning('Deleting admin: %s', self)
-        return super(Admin, self).delete_instance(recursive=recursive, delete_nullable=delete_nullable)
+        try:
+            return super(Admin, self).delete_instance(recursive=recursive, delete_nullable=delete_nullable)
+        finally:
+            self.notify_changed()
     
     
     @classmethod
@@ -67,13 +96,14 @@ class Admin(BaseModel):
         
         if user.telegram_id in [None, DEFAULT_TELEGRAM_ID] and tg_user.id is not None:
             user.telegram_id = tg_user.id
-        if tg_user.first_name is not None:
+        # only the values really changed are set, so is_dirty() tells if the admin needs to be saved
+        if tg_user.first_name is not None and user.first_name != tg_user.first_name:
             user.first_name = tg_user.first_name
-        if tg_user.last_name is not None:
+        if tg_user.last_name is not None and user.last_name != tg_user.last_name:
             user.last_name = tg_user.last_name
-        if tg_user.username is not None:
+        if tg_user.username is not None and user.username != tg_user.username:
             user.username = tg_user.username
-        if chat_id is not None:
+        if chat_id is not None and admin.chat_id != chat_id:
             admin.chat_id = chat_id
         
         if update_db:
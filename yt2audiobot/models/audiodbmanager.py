@@ -5,6 +5,8 @@ from __future__ import unicode_literals
 
 import logging
 from peewee import *
+from playhouse.migrate import migrate
+from playhouse.migrate import SqliteMigrator
 
 from yt2audiobot import settings
 
@@ -37,16 +39,34 @@ class AudioMetadata(Model):
     first_release_date = DateField(null=True)
     file_size = IntegerField(default=0)
     duration = IntegerField(default=0)
+    codec = CharField(null=True)  # codec and bitrate (kbps) of the file sent, see codecpolicy
+    bitrate = IntegerField(null=True)
     
     class Meta:
         database = audio_db
 
 
 class AudioDBController(object):
+    MAX_VARIABLES_PER_QUERY = 500
+    
+    
     def __init__(self):
         self.db = audio_db
         self.db.connect()
         self.db.create_tables([YoutubeToTelegramFile, AudioMetadata], safe=True)
+        self.__add_missing_columns()
+    
+    
+    def __add_missing_columns(self):
+        # the columns added after the table was created are nullable: they are added without asking
+        migrator = SqliteMigrator(self.db)
+        for table in [YoutubeToTelegramFile, AudioMetadata]:
+            column_names = [c.name for c in self.db.get_columns(table._meta.db_table)]
+            for field in table._meta.sorted_fields:
+                if field.db_column not in column_names and field.null:
+                    logger.warning('Create new column: \'%s\' in %s', field.db_column, table._meta.db_table)
+                    with self.db.transaction():
+                        migrate(migrator.add_column(table._meta.db_table, field.db_column, field))
     
     
     def __predicate_youtube_and_telegram_file(self, youtube_id=None, telegram_file_id=None):
@@ -76,6 +96,24 @@ class AudioDBController(object):
             return (entry, None)
     
     
+    def search_by_youtube_ids(self, youtube_ids):
+        # a single query (per chunk: sqlite limits the number of variables) joining the mappings with their metadata
+        # returns a dict youtube_id -> (YoutubeToTelegramFile, AudioMetadata or None) with only the ids found
+        youtube_ids = list(set(youtube_ids))
+        found = { }
+        for i in range(0, len(youtube_ids), self.MAX_VARIABLES_PER_QUERY):
+            chunk = youtube_ids[i:i + self.MAX_VARIABLES_PER_QUERY]
+            query = (YoutubeToTelegramFile
+                     .select(YoutubeToTelegramFile, AudioMetadata)
+                     .join(AudioMetadata, JOIN.LEFT_OUTER,
+                           on=(AudioMetadata.mapping == YoutubeToTelegramFile.youtube_id).alias('metadata'))
+                     .where(YoutubeToTelegramFile.youtube_id << chunk))
+            for entry in query:
+                metadata = entry.metadata if entry.metadata.title is not None else None
+                found[entry.youtube_id] = (entry, metadata)
+        return found
+    
+    
     def __add_youtube_telegram_file(self, **attributes):
         youtube_id = attributes.get('youtube_id', None)
         if youtube_id is None:
@@ -101,6 +139,8 @@ class AudioDBController(object):
             first_release_date=attributes.get('first_release_date', None),
             file_size=attributes.get('file_size', 0),
             duration=attributes.get('duration', 0),
+            codec=attributes.get('codec', None),
+            bitrate=attributes.get('bitrate', None),
         )
     
     
@@ -113,3 +153,10 @@ class AudioDBController(object):
                 self.__add_metadata_to_entry(yt2tgmapping, **attributes)
         except CannotAddEntryException as e:
             raise CannotAddEntryException(str(e) + ' - title: ' + str(attributes['title']))
+    
+    
+    def update_metadata(self, youtube_id, **attributes):
+        # replaces the metadata of an entry already added (i.e. after the late enrichment of the audio)
+        fields = ['title', 'author', 'album', 'track_number', 'first_release_date']
+        values = dict((field, attributes[field]) for field in fields if field in attributes)
+        return AudioMetadata.update(**values).where(AudioMetadata.mapping == youtube_id).execute()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import json
+import time
+import logging
+from peewee import *
+from peewee import PeeweeException
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+from yt2audiobot import settings
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+# opened lazily by the processes resolving the metadata: the bot process never connects to it, so the connection
+# is never inherited by the forked download processes
+metadata_cache_db = SqliteExtDatabase(settings.ABS_PATH_METADATA_CACHE_DB, timeout=10)
+
+
+class CachedResponse(Model):
+    key = CharField(primary_key=True)  # namespace:query
+    value = TextField(null=True)  # json, null if the query has no result
+    expires_at = FloatField(index=True)
+    accessed_at = FloatField(index=True)
+
+    class Meta:
+        database = metadata_cache_db
+
+
+class MetadataCache(object):
+    # Persistent cache of the metadata lookups (resolved titles and raw musixmatch/spotify responses) with a ttl
+    # and a maximum number of entries, the least recently used are evicted. A None value is a negative result:
+    # it is cached too, with its own (shorter) ttl. Any database error is logged and treated as a miss.
+    MISS = object()
+    EVICTION_PERIOD = 100  # sets between two evictions
+
+
+    def __init__(self, ttl=settings.METADATA_CACHE_TTL, negative_ttl=settings.METADATA_CACHE_NEGATIVE_TTL,
+                 max_entries=settings.METADATA_CACHE_MAX_ENTRIES):
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._max_entries = max_entries
+        self._tables_created = False
+        self._sets = 0
+
+
+    def _ensure_tables(self):
+        if not self._tables_created:
+            metadata_cache_db.create_tables([CachedResponse], safe=True)
+            self._tables_created = True
+
+
+    def get(self, namespace, query):
+        key = '%s:%s' % (namespace, query)
+        now = time.time()
+        try:
+            self._ensure_tables()
+            entry = CachedResponse.select().where(
+                (CachedResponse.key == key) & (CachedResponse.expires_at > now)).first()
+            if entry is None:
+                return MetadataCache.MISS
+            CachedResponse.update(accessed_at=now).where(CachedResponse.key == key).execute()
+            return json.loads(entry.value) if entry.value is not None else None
+        except (PeeweeException, ValueError) as e:
+            logger.warning('Metadata cache: cannot read %s: %s', key, e)
+            return MetadataCache.MISS
+
+
+    def set(self, namespace, query, value, ttl=None):
+        key = '%s:%s' % (namespace, query)
+        if ttl is None:
+            ttl = self._ttl if value is not None else self._negative_ttl
+        now = time.time()
+        try:
+            self._ensure_tables()
+            CachedResponse.insert(
+                key=key,
+                value=json.dumps(value) if value is not None else None,
+                expires_at=now + ttl,
+                accessed_at=now
+            ).upsert().execute()
+            self._sets += 1
+            if self._sets % self.EVICTION_PERIOD == 0:
+                self.evict()
+        except (PeeweeException, TypeError) as e:
+            logger.warning('Metadata cache: cannot write %s: %s', key, e)
+
+
+    def evict(self):
+        with metadata_cache_db.atomic():
+            CachedResponse.delete().where(CachedResponse.expires_at <= time.time()).execute()
+            exceeding = CachedResponse.select().count() - self._max_entries
+            if exceeding > 0:
+                lru = CachedResponse.select(CachedResponse.key).order_by(CachedResponse.accessed_at).limit(exceeding)
+                CachedResponse.delete().where(CachedResponse.key << lru).execute()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import re
+import hashlib
+import logging
+from peewee import PeeweeException
+from playhouse.sqlite_ext import *
+
+from yt2audiobot import settings
+from .metadatacache import metadata_cache_db
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+TOKEN_REGEX = re.compile(r'\w+', flags=re.UNICODE)
+
+
+class IndexedSong(FTSModel):
+    # the docid is derived from author and title, so the same song is indexed only once
+    title = TextField()
+    author = TextField()
+    album = TextField()
+    track_number = TextField()
+    first_release_date = TextField()
+
+    class Meta:
+        database = metadata_cache_db
+
+
+def tokenize(text):
+    return set(t.lower() for t in TOKEN_REGEX.findall(text or ''))
+
+
+def match_score(query_tokens, title, author):
+    # F1 of the words shared by the query and the song (title + author)
+    song_tokens = tokenize(title) | tokenize(author)
+    common = len(query_tokens & song_tokens)
+    if common == 0:
+        return 0.0
+    precision = float(common) / len(query_tokens)
+    recall = float(common) / len(song_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+
+def _song_docid(data):
+    key = '%s\n%s' % (' '.join(sorted(tokenize(data['author']))), ' '.join(sorted(tokenize(data['title']))))
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:15], 16)
+
+
+class MetadataIndex(object):
+    # Local full text index of the songs already resolved and of the imported catalogs. The FTS query finds the
+    # candidates sharing a word with the title, the best one is used only if its match_score is at least min_score.
+    # Any database error is logged and treated as not found.
+
+    def __init__(self, min_score=settings.METADATA_INDEX_MIN_SCORE, max_candidates=settings.METADATA_INDEX_CANDIDATES):
+        self._min_score = min_score
+        self._max_candidates = max_candidates
+        self._tables_created = False
+
+
+    def _ensure_tables(self):
+        if not self._tables_created:
+            metadata_cache_db.create_tables([IndexedSong], safe=True)
+            self._tables_created = True
+
+
+    def search(self, query_tokens):
+        # returns (data, score) of the best song, data is None if no song scores enough
+        if len(query_tokens) == 0:
+            return None, 0.0
+        fts_query = ' OR '.join('"%s"' % t for t in query_tokens)
+        try:
+            self._ensure_tables()
+            candidates = list(IndexedSong.select()
+                              .where(IndexedSong.match(fts_query))
+                              .order_by(IndexedSong.bm25())
+                              .limit(self._max_candidates))
+        except PeeweeException as e:
+            logger.warning('Metadata index: cannot search %s: %s', fts_query, e)
+            return None, 0.0
+
+        best, best_score = None, 0.0
+        for song in candidates:
+            score = match_score(query_tokens, song.title, song.author)
+            if score > best_score:
+                best, best_score = song, score
+        if best is None or best_score < self._min_score:
+            return None, best_score
+        data = {
+            'title': best.title,
+            'author': best.author or None,
+            'album': best.album or None,
+            'track_number': int(best.track_number or 0),
+            'first_release_date': best.first_release_date or None
+        }
+        return data, best_score
+
+
+    def add(self, data):
+        self.add_many([data])
+
+
+    def add_many(self, songs):
+        # songs: dicts with the SongMetadata keys, the dates already formatted as strings
+        count = 0
+        try:
+            self._ensure_tables()
+            with metadata_cache_db.atomic():
+                for data in songs:
+                    if not data.get('title', None):
+                        continue
+                    IndexedSong.insert(
+                        docid=_song_docid(data),
+                        title=data['title'],
+                        author=data.get('author', None) or '',
+                        album=data.get('album', None) or '',
+                        track_number=str(data.get('track_number', None) or 0),
+                        first_release_date=data.get('first_release_date', None) or ''
+                    ).upsert().execute()
+                    count += 1
+        except PeeweeException as e:
+            logger.warning('Metadata index: cannot add the songs: %s', e)
+        return count
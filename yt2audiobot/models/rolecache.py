@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from yt2audiobot import settings
+from .authorizeduser import AuthorizedUser
+from .admin import Admin
+from .root import Root
+from .usersutils import DEFAULT_TELEGRAM_ID
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+
+class UserRoles(object):
+    def __init__(self, tg_user, authorized_user, admin, is_root):
+        self.authorized_user_id = authorized_user.id if authorized_user is not None else None
+        self.telegram_id = authorized_user.telegram_id if authorized_user is not None else tg_user.id
+        self.username = authorized_user.username if authorized_user is not None else tg_user.username
+        self.is_authorized = authorized_user is not None and authorized_user.is_authorized()
+        self.is_banned = authorized_user is not None and authorized_user.is_banned()
+        self.is_admin = admin is not None
+        self.is_root = is_root
+        self._admin_profile = None
+        if admin is not None:
+            self._admin_profile = {
+                'first_name': authorized_user.first_name,
+                'last_name': authorized_user.last_name,
+                'username': authorized_user.username,
+                'chat_id': admin.chat_id
+            }
+
+
+    def admin_profile_matches(self, tg_user, chat_id):
+        # True if Admin.from_telegram_user wouldn't change anything of the admin
+        if self._admin_profile is None or self.telegram_id in [None, DEFAULT_TELEGRAM_ID]:
+            # the telegram_id of the admin still needs to be stored
+            return False
+        for key in ['first_name', 'last_name', 'username']:
+            value = getattr(tg_user, key)
+            if value is not None and value != self._admin_profile[key]:
+                return False
+        return chat_id is None or chat_id == self._admin_profile['chat_id']
+
+
+class RoleCache(object):
+    # TTL + LRU cache of the roles of the telegram users, keyed by telegram_id. The entries have to be invalidated
+    # whenever an AuthorizedUser, Admin or Root row of the user is changed.
+
+    def __init__(self, ttl=settings.ROLE_CACHE_TTL, max_size=settings.ROLE_CACHE_SIZE):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # telegram_id -> (expiration, UserRoles)
+
+
+    @staticmethod
+    def _resolve(tg_user):
+        authorized_user = AuthorizedUser._select_from_telegram_user(tg_user)
+        admin = None
+        is_root = False
+        if authorized_user is not None:
+            admin = Admin.select().where(Admin.authorized_user == authorized_user).first()
+        if admin is not None:
+            is_root = Root.select().where(Root.admin == admin).exists()
+        return UserRoles(tg_user, authorized_user, admin, is_root)
+
+
+    def get(self, tg_user):
+        if tg_user.id is None:
+            return self._resolve(tg_user)
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(tg_user.id, None)
+            if entry is not None and entry[0] > now:
+                # reinserted as the most recently used
+                self._entries[tg_user.id] = entry
+                return entry[1]
+
+        roles = self._resolve(tg_user)
+        with self._lock:
+            self._entries[tg_user.id] = (now + self._ttl, roles)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+        return roles
+
+
+    def invalidate(self, telegram_id=None, username=None):
+        with self._lock:
+            if telegram_id is not None:
+                self._entries.pop(telegram_id, None)
+            if username is not None:
+                # the users added by username are cached under their telegram_id
+                for key in [k for k, (_, roles) in self._entries.items() if roles.username == username]:
+                    del self._entries[key]
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
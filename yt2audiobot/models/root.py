@@ -4,6 +4,7 @@
 from __future__ import unicode_literals
 
 import logging
+import threading
 from playhouse.migrate import *
 
 from yt2audiobot import settings
@@ -21,10 +22,32 @@ class Root(BaseModel):
     admin = ForeignKeyField(Admin, primary_key=True)
     
     
+    _root_chat_ids = None  # (Admin.get_changes_count(), chat ids)
+    _root_chat_ids_lock = threading.Lock()
+    
+    
+    def save(self, *args, **kwargs):
+        result = super(Root, self).save(*args, **kwargs)
+        Admin.notify_changed()
+        return result
+    
+    
+    def delete_instance(self, recursive=False, delete_nullable=False):
+        try:
+            return super(Root, self).delete_instance(recursive=recursive, delete_nullable=delete_nullable)
+        finally:
+            Admin.notify_changed()
+    
+    
     @classmethod
     def get_root_chat_id(cls):
-        q = Admin.select(Admin.chat_id).join(cls)
-        return [admin.chat_id for admin in q]
+        # the chat ids are loaded again only if an admin or a root has been changed in the meantime
+        with cls._root_chat_ids_lock:
+            changes = Admin.get_changes_count()
+            if Root._root_chat_ids is None or Root._root_chat_ids[0] != changes:
+                q = Admin.select(Admin.chat_id).join(cls)
+                Root._root_chat_ids = (changes, [admin.chat_id for admin in q])
+            return list(Root._root_chat_ids[1])
     
     
     @classmethod
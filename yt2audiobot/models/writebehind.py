@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import logging
+import datetime
+import threading
+
+from yt2audiobot import settings
+from .audiodbmanager import audio_db
+from .audiodbmanager import YoutubeToTelegramFile
+from .authorizeduser import AuthorizedUser
+from .base import get_database
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+
+class WriteBehindBuffer(object):
+    # Accumulates in memory the downloaded_times increments and the last_connection updates, that are written
+    # in a single transaction per database every `flush_interval` seconds, as soon as `max_pending` updates
+    # are buffered or when the buffer is stopped.
+    
+    def __init__(self, flush_interval=settings.WRITE_BEHIND_FLUSH_INTERVAL,
+                 max_pending=settings.WRITE_BEHIND_MAX_PENDING):
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._lock = threading.Lock()
+        self._downloaded_times = { }  # youtube_id -> increment
+        self._last_connections = { }  # AuthorizedUser id -> datetime
+        self._flush_event = threading.Event()
+        self._stopped = False
+        
+        self._thread = threading.Thread(target=self._run, name='WriteBehindBuffer')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    
+    def _pending_count(self):
+        return len(self._downloaded_times) + len(self._last_connections)
+    
+    
+    def increment_downloaded_times(self, youtube_id, count=1):
+        with self._lock:
+            self._downloaded_times[youtube_id] = self._downloaded_times.get(youtube_id, 0) + count
+            if self._pending_count() >= self._max_pending:
+                self._flush_event.set()
+    
+    
+    def touch_last_connection(self, authorized_user_id):
+        with self._lock:
+            self._last_connections[authorized_user_id] = datetime.datetime.now()
+            if self._pending_count() >= self._max_pending:
+                self._flush_event.set()
+    
+    
+    def _run(self):
+        while not self._stopped:
+            self._flush_event.wait(self._flush_interval)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('[Write Behind] flush failed: %s', e)
+    
+    
+    def _restore_downloaded_times(self, downloaded_times):
+        # the transaction has been rolled back: the increments are added to the ones buffered in the meanwhile
+        with self._lock:
+            for youtube_id, count in downloaded_times.items():
+                self._downloaded_times[youtube_id] = self._downloaded_times.get(youtube_id, 0) + count
+    
+    
+    def _restore_last_connections(self, last_connections):
+        # the last connections buffered in the meanwhile are newer
+        with self._lock:
+            for user_id, last_connection in last_connections.items():
+                self._last_connections.setdefault(user_id, last_connection)
+    
+    
+    def flush(self):
+        with self._lock:
+            downloaded_times, self._downloaded_times = self._downloaded_times, { }
+            last_connections, self._last_connections = self._last_connections, { }
+        
+        if len(downloaded_times) > 0:
+            try:
+                with audio_db.atomic():
+                    for youtube_id, count in downloaded_times.items():
+                        (YoutubeToTelegramFile
+                         .update(downloaded_times=YoutubeToTelegramFile.downloaded_times + count)
+                         .where(YoutubeToTelegramFile.youtube_id == youtube_id)
+                         .execute())
+            except Exception:
+                self._restore_downloaded_times(downloaded_times)
+                self._restore_last_connections(last_connections)
+                raise
+        
+        if len(last_connections) > 0:
+            try:
+                with get_database().atomic():
+                    for user_id, last_connection in last_connections.items():
+                        (AuthorizedUser
+                         .update(last_connection=last_connection)
+                         .where(AuthorizedUser.id == user_id)
+                         .execute())
+            except Exception:
+                self._restore_last_connections(last_connections)
+                raise
+        
+        if len(downloaded_times) + len(last_connections) > 0:
+            logger.debug('[Write Behind] flushed %d counters and %d last connections',
+                         len(downloaded_times), len(last_connections))
+    
+    
+    def stop(self):
+        self._stopped = True
+        self._flush_event.set()
+        self._thread.join()
+        self.flush()
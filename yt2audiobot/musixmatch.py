@@ -3,13 +3,17 @@
 
 from __future__ import unicode_literals, absolute_import
 
+import json
 import logging
-import requests
 from datetime import datetime
 from telebot.types import JsonDeserializable
 
 
 from yt2audiobot import settings
+from yt2audiobot import httpsessions
+from yt2audiobot.apiclient import ProviderClient
+from yt2audiobot.apiclient import ProviderThrottledException
+from yt2audiobot.apiclient import parse_retry_after
 
 
 logger = logging.getLogger(settings.BOT_NAME)
@@ -124,15 +128,43 @@ class Message(JsonDeserializable):
             setattr(self, key, options[key])
 
 
+class MusixmatchException(Exception):
+    pass
+
+
+# https://developer.musixmatch.com/documentation/status-codes
+USAGE_LIMIT_REACHED = 402
+
+_client = ProviderClient('musixmatch', settings.MUSIXMATCH_RATE)
+
+
 def __do_mxm_request(method, data):
     MUSIXMATCH_URL = 'http://api.musixmatch.com/ws/1.1/'
     data['apikey'] = settings.BOT_SECRETS['musixmatch_key']
     data['format'] = 'json'
-    result = requests.get(MUSIXMATCH_URL + method, params=data)
-    return Message.de_json(result.text.encode('ascii', 'ignore'))
+    
+    def request():
+        result = httpsessions.get_session('musixmatch').get(MUSIXMATCH_URL + method, params=data)
+        if result.status_code == 429:
+            raise ProviderThrottledException('musixmatch: too many requests',
+                                             parse_retry_after(result.headers.get('Retry-After', None)))
+        raw_message = json.loads(result.text.encode('ascii', 'ignore'))
+        status_code = raw_message['message']['header']['status_code']
+        if status_code == USAGE_LIMIT_REACHED:
+            raise ProviderThrottledException('musixmatch: usage limit reached', settings.MUSIXMATCH_QUOTA_RETRY_AFTER)
+        if status_code != 200:
+            raise MusixmatchException('musixmatch %s: status code %s' % (method, status_code))
+        return raw_message
+    
+    return _client.call(request)
+
+
+def is_successful(raw_message):
+    return raw_message['message']['header']['status_code'] == 200
 
 
-def track_search(title):
+def track_search_raw(title):
+    # the json response, it can be cached and parsed later with Message.de_json
     req = {
         'q': title,
         's_track_rating': 'desc'
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import json
+import logging
+import threading
+
+import telebot
+
+from yt2audiobot import settings
+from yt2audiobot.ratelimiter import PRIORITY_PROGRESS
+from yt2audiobot.workerpool import ChatOrderedWorkerPool
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+
+class ProgressReporter(object):
+    # Asynchronous sink for the progress messages. update() never blocks: it only keeps the latest text of every
+    # message, a background thread edits the messages every `interval` seconds skipping the unchanged ones.
+    # The edits are sent by a small pool, so a chat waiting for the outbound scheduler doesn't hold back the others
+
+    def __init__(self, bot, interval=settings.PROGRESS_UPDATE_INTERVAL, num_threads=settings.PROGRESS_REPORTER_THREADS):
+        self._bot = bot
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._pending = { }  # (chat_id, message_id) -> (text, final)
+        self._last_sent = { }  # (chat_id, message_id) -> text of the last successful edit
+        self._sending = set()  # (chat_id, message_id) being edited right now
+        self._edit_pool = ChatOrderedWorkerPool(num_threads)
+        self._stop_event = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name='ProgressReporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def update(self, chat_id, message_id, text, final=False):
+        # final means that the message won't be updated anymore, so its state can be forgotten once sent
+        with self._lock:
+            self._pending[(chat_id, message_id)] = (text, final)
+
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval):
+            self.flush()
+
+
+    def flush(self):
+        with self._lock:
+            # the messages still being edited keep their latest text for the next flush
+            pending = dict((k, v) for k, v in self._pending.items() if k not in self._sending)
+            for key in pending:
+                del self._pending[key]
+
+            for key, (text, final) in pending.items():
+                if self._last_sent.get(key, None) != text:
+                    self._sending.add(key)
+                    self._edit_pool.put(key, self._edit_message, key, text, final)
+                elif final:
+                    del self._last_sent[key]
+
+
+    def _edit_message(self, key, text, final):
+        # the text is the last sent only once the edit has succeeded: after a failure the next update is sent even
+        # with the same text
+        chat_id, message_id = key
+        sent = False
+        try:
+            self._bot.edit_message_text(text, chat_id, message_id, disable_web_page_preview=True,
+                                        priority=PRIORITY_PROGRESS)
+            sent = True
+        except telebot.apihelper.ApiException as e:
+            if 'message is not modified' in json.loads(e.result.text)['description']:
+                sent = True
+            else:
+                logger.error('Cannot update the progress of %s: %s', key, e)
+        except Exception as e:
+            logger.error('Cannot update the progress of %s: %s', key, e)
+        finally:
+            with self._lock:
+                self._sending.discard(key)
+                if final:
+                    self._last_sent.pop(key, None)
+                elif sent:
+                    self._last_sent[key] = text
+
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+        self.flush()
+        self._edit_pool.close()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import json
+import time
+import bisect
+import logging
+import itertools
+import threading
+
+import telebot
+
+from yt2audiobot import settings
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+PRIORITY_AUDIO = 0
+PRIORITY_MESSAGE = 1
+PRIORITY_PROGRESS = 2
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._timestamp = time.time()
+        self._lock = threading.Lock()
+
+
+    def _refill(self, now):
+        if now > self._timestamp:
+            self._tokens = min(self.capacity, self._tokens + (now - self._timestamp) * self.rate)
+            self._timestamp = now
+
+
+    def delay(self, now=None):
+        # seconds to wait before a token is available
+        with self._lock:
+            self._refill(now or time.time())
+            if self._tokens >= 1:
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+    def consume(self, now=None):
+        with self._lock:
+            self._refill(now or time.time())
+            self._tokens -= 1
+
+
+    def try_consume(self):
+        with self._lock:
+            self._refill(time.time())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+    def acquire(self):
+        # blocks until a token is available
+        while True:
+            with self._lock:
+                self._refill(time.time())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+    def pause(self, seconds):
+        # no token will be available for the next `seconds`
+        with self._lock:
+            self._refill(time.time())
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+    def is_full(self):
+        with self._lock:
+            self._refill(time.time())
+            return self._tokens >= self.capacity
+
+
+def get_retry_after(api_exception):
+    # returns the seconds to wait if the exception is a 429 Too Many Requests, otherwise None
+    result = getattr(api_exception, 'result', None)
+    if result is None or result.status_code != 429:
+        return None
+    try:
+        return json.loads(result.text)['parameters']['retry_after']
+    except (ValueError, KeyError, TypeError):
+        return 1
+
+
+class OutboundScheduler(object):
+    # Paces every call to the telegram API with a global token bucket and a token bucket per chat.
+    # The callers waiting for a token are served by priority (audio first, progress edits last) and, among the
+    # same priority, in arrival order. A chat without tokens doesn't hold back the callers of the other chats.
+
+    def __init__(self, global_rate=settings.TELEGRAM_GLOBAL_RATE, chat_rate=settings.TELEGRAM_CHAT_RATE,
+                 group_chat_rate=settings.TELEGRAM_GROUP_CHAT_RATE, max_retries=settings.TELEGRAM_MAX_RETRIES):
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._group_chat_rate = group_chat_rate
+        self._max_retries = max_retries
+        self._chat_buckets = { }
+        self._waiting = []  # sorted list of (priority, seq, chat_id)
+        self._seq = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+
+
+    def _get_chat_bucket(self, chat_id):
+        if chat_id is None:
+            return None
+        bucket = self._chat_buckets.get(chat_id, None)
+        if bucket is None:
+            if len(self._chat_buckets) > settings.TELEGRAM_MAX_CHAT_BUCKETS:
+                # the full buckets are the same as new ones: they can be forgotten
+                for key in [k for k, b in self._chat_buckets.items() if b.is_full()]:
+                    del self._chat_buckets[key]
+            # group chats ids are negative
+            rate = self._group_chat_rate if chat_id < 0 else self._chat_rate
+            bucket = TokenBucket(rate, settings.TELEGRAM_CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+
+    def _chat_delay(self, chat_id, now):
+        bucket = self._get_chat_bucket(chat_id)
+        return bucket.delay(now) if bucket is not None else 0
+
+
+    def _acquire(self, chat_id, priority):
+        with self._cond:
+            ticket = (priority, next(self._seq), chat_id)
+            bisect.insort(self._waiting, ticket)
+            try:
+                while True:
+                    now = time.time()
+                    wait = self._global_bucket.delay(now)
+                    if wait == 0:
+                        chat_delays = [(self._chat_delay(t[2], now), t) for t in self._waiting]
+                        ready = [t for delay, t in chat_delays if delay == 0]
+                        if len(ready) > 0 and ready[0] is ticket:
+                            self._global_bucket.consume(now)
+                            bucket = self._get_chat_bucket(chat_id)
+                            if bucket is not None:
+                                bucket.consume(now)
+                            return
+                        if len(ready) > 0:
+                            # another caller has precedence: let it go first
+                            self._cond.notify_all()
+                        wait = min(delay for delay, _ in chat_delays if delay > 0) if len(ready) == 0 else 0.05
+                    self._cond.wait(wait)
+            finally:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+
+
+    def _pause(self, chat_id, seconds):
+        with self._cond:
+            bucket = self._get_chat_bucket(chat_id)
+            (bucket or self._global_bucket).pause(seconds)
+
+
+    def call(self, chat_id, priority, func, *args, **kwargs):
+        retries = 0
+        while True:
+            self._acquire(chat_id, priority)
+            try:
+                return func(*args, **kwargs)
+            except telebot.apihelper.ApiException as e:
+                retry_after = get_retry_after(e)
+                if retry_after is None or retries >= self._max_retries:
+                    raise
+                retries += 1
+                logger.warning('[429] %s for chat %s: retry after %s seconds (%d/%d)',
+                               getattr(func, '__name__', func), chat_id, retry_after, retries, self._max_retries)
+                self._pause(chat_id, retry_after)
+                # the files already sent need to be read again
+                for arg in list(args) + list(kwargs.values()):
+                    if hasattr(arg, 'seek'):
+                        arg.seek(0)
@@ -4,6 +4,7 @@
 from __future__ import unicode_literals
 
 import os
+import multiprocessing
 
 
 BOT_NAME = 'yt2audiobot'
@@ -16,31 +17,130 @@ URL_REPO_GITHUB = 'https://github.com/gise88/yt2audiobot'
 REQUESTED_ACCESS_FOR_BAN = 5
 
 
+# number of threads handling the telegram updates (the updates of the same chat are always handled in order)
+WORKER_POOL_SIZE = 4
+
+# number of processes downloading the videos and extracting the audio
+JOB_PROCESS_POOL_SIZE = multiprocessing.cpu_count()
+# seconds a download job can run before its process is killed and the job failed
+JOB_TIMEOUT = 20 * 60
+# number of videos of the same playlist downloaded at the same time
+PLAYLIST_CONCURRENCY = 3
+# send the audio right after the extraction, untagged: the metadata are searched afterwards and stored in the db only
+FAST_DELIVERY = False
+
+# seconds between two updates of the same progress message (telegram doesn't like too many edits)
+PROGRESS_UPDATE_INTERVAL = 1.5
+# number of threads editing the progress messages
+PROGRESS_REPORTER_THREADS = 4
+
+# outbound telegram api limits: https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+TELEGRAM_GLOBAL_RATE = 30  # requests per second
+TELEGRAM_CHAT_RATE = 1  # requests per second in the same private chat
+TELEGRAM_GROUP_CHAT_RATE = 20 / 60.0  # requests per second in the same group
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_MAX_CHAT_BUCKETS = 1000
+TELEGRAM_MAX_RETRIES = 3  # retries after a 429 Too Many Requests
+
+
+# outbound http: keep-alive connections per host of every session and retries of the connection errors
+HTTP_POOL_SIZE = 4
+HTTP_TELEGRAM_POOL_SIZE = WORKER_POOL_SIZE + PROGRESS_REPORTER_THREADS + 2
+HTTP_TIMEOUT = 10
+HTTP_MAX_RETRIES = 3
+
+
 # in this folder will be created the sqlite databases and the output directory for the audio files
 WORKING_DIRECTORY_ABS_PATH = os.path.abspath('.')
 SECRETS_FILE_NAME = 'SECRETS.txt'
 USERS_DB_NAME = 'yt2audiobot_users.sqlite'
 AUDIO_DB_NAME = 'yt2audiobot_audio.sqlite'
+METADATA_CACHE_DB_NAME = 'yt2audiobot_metadata_cache.sqlite'
 AUDIO_OUTPUT_DIR_NAME = 'output_dir'
+# optional tmpfs directory (i.e. '/dev/shm/yt2audiobot') for the files of the jobs: the jobs use AUDIO_OUTPUT_DIR
+# when it hasn't room for them and for the reserve
+AUDIO_TMPFS_DIR = None
+AUDIO_TMPFS_RESERVE = 64 << 20
+# the jobs write their files in this subdirectory of AUDIO_OUTPUT_DIR and of AUDIO_TMPFS_DIR: it belongs to the bot,
+# everything in it at startup is an orphan of the previous run and is deleted
+AUDIO_JOBS_DIR_NAME = 'jobs'
+# the audios of the last jobs are kept, up to this size, to be uploaded again without downloading them
+AUDIO_HOT_TIER_SIZE = 500 << 20
 PREFERRED_AUDIO_CODEC = 'mp3'
+# 'encode' (default): the audio is always encoded to PREFERRED_AUDIO_CODEC, as the bot always did. 'original' (opt-in):
+# the audio stream of the video is only remuxed (no encoding) when its format is in PASSTHROUGH_AUDIO_FORMATS,
+# telegram can send it as an audio
+AUDIO_CODEC_POLICY = 'encode'
+PASSTHROUGH_AUDIO_FORMATS = ['m4a']
+# opt-in: the audio stream is piped into ffmpeg while it is downloaded, instead of being downloaded to a file first
+# (the formats that cannot be streamed, and the failed streams, are downloaded as before)
+STREAMING_PIPELINE = False
+# the covers embedded in the audios are scaled down to COVER_MAX_DIMENSION pixels and COVER_MAX_BYTES, and cached
+# (the least recently used are evicted beyond the disk budget)
+COVER_CACHE_DIR_NAME = 'cover_cache'
+COVER_MAX_DIMENSION = 600
+COVER_MAX_BYTES = 100 << 10
+COVER_CACHE_DISK_BUDGET = 50 << 20
 LIMIT_VIDEO_DURATION = 60 * 30
+# bitrates (kbps) of the extracted audio: the first one is preferred, the others are used when it would be too large
+AUDIO_QUALITIES = [192, 160, 128, 96, 64]
+# https://core.telegram.org/bots/faq#how-do-i-upload-a-large-file
+MAX_AUDIO_FILE_SIZE = 50 << 20
 
 
 # paths
 SECRETS_PATH = os.path.join(WORKING_DIRECTORY_ABS_PATH, SECRETS_FILE_NAME)
 AUDIO_OUTPUT_DIR = os.path.join(WORKING_DIRECTORY_ABS_PATH, AUDIO_OUTPUT_DIR_NAME)
+COVER_CACHE_DIR = os.path.join(WORKING_DIRECTORY_ABS_PATH, COVER_CACHE_DIR_NAME)
 
 
 # ythelper settings
-OUTPUT_FORMAT = os.path.join(AUDIO_OUTPUT_DIR, '%(id)s.%(ext)s')
+OUTPUT_TEMPLATE = '%(id)s.%(ext)s'  # in the jobs directory chosen by storage.choose_output_dir
 
 
 # dbmanagers settings
 ABS_PATH_USERS_DB = os.path.join(WORKING_DIRECTORY_ABS_PATH, USERS_DB_NAME)
 ABS_PATH_AUDIO_DB = os.path.join(WORKING_DIRECTORY_ABS_PATH, AUDIO_DB_NAME)
+ABS_PATH_METADATA_CACHE_DB = os.path.join(WORKING_DIRECTORY_ABS_PATH, METADATA_CACHE_DB_NAME)
+# the counters and the last connections are written every WRITE_BEHIND_FLUSH_INTERVAL seconds or as soon as
+# WRITE_BEHIND_MAX_PENDING updates are buffered
+WRITE_BEHIND_FLUSH_INTERVAL = 10
+WRITE_BEHIND_MAX_PENDING = 100
+# the roles of the users (authorized, admin, root) are cached for ROLE_CACHE_TTL seconds
+ROLE_CACHE_TTL = 60 * 5
+ROLE_CACHE_SIZE = 1000
+
+
+# the metadata resolved from the titles and the musixmatch/spotify responses are cached for METADATA_CACHE_TTL
+# seconds, the titles that cannot be resolved for METADATA_CACHE_NEGATIVE_TTL seconds
+METADATA_CACHE_TTL = 60 * 60 * 24 * 30
+METADATA_CACHE_NEGATIVE_TTL = 60 * 60 * 24
+METADATA_CACHE_MAX_ENTRIES = 10000
+# the local index of the songs is used instead of musixmatch and spotify when its best song scores at least
+# METADATA_INDEX_MIN_SCORE (0-1, how much the words of the title and of the song overlap)
+METADATA_INDEX_MIN_SCORE = 0.8
+METADATA_INDEX_CANDIDATES = 20
+# musixmatch and spotify are queried at the same time, after METADATA_RESOLUTION_TIMEOUT seconds the video title is used
+METADATA_RESOLVER_THREADS = 4
+METADATA_RESOLUTION_TIMEOUT = 15
+
+
+# musixmatch and spotify api: requests per second of the bot (split among the JOB_PROCESS_POOL_SIZE download
+# processes), the throttled requests are retried after their Retry-After only if it's shorter than
+# PROVIDER_MAX_RETRY_AFTER, otherwise the provider is skipped in the meantime.
+# After PROVIDER_FAILURE_THRESHOLD consecutive failures a provider is skipped for PROVIDER_RESET_TIMEOUT seconds
+MUSIXMATCH_RATE = 1
+SPOTIFY_RATE = 5
+PROVIDER_BURST = 3
+PROVIDER_MAX_RETRIES = 2
+PROVIDER_MAX_RETRY_AFTER = 10
+PROVIDER_FAILURE_THRESHOLD = 5
+PROVIDER_RESET_TIMEOUT = 60
+MUSIXMATCH_QUOTA_RETRY_AFTER = 60 * 60
 
 
 # spotifyhelper settings
+SPOTIFY_TRACKS_MEMO_SIZE = 1000
 BAD_WORDS = [
     '[', ']', '(', ')',
     'ft', 'feat',
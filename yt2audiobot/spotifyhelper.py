@@ -3,15 +3,52 @@
 
 from __future__ import unicode_literals
 
+import threading
+from collections import OrderedDict
+
 import spotipy
 import settings
+from yt2audiobot import httpsessions
+from yt2audiobot.apiclient import ProviderClient
+from yt2audiobot.apiclient import ProviderThrottledException
+from yt2audiobot.apiclient import parse_retry_after
 from spotipy.oauth2 import SpotifyClientCredentials
 
 
+class _SingleAttemptSpotify(spotipy.Spotify):
+    # spotipy sleeps and retries the throttled requests by itself (and returns None when it gives up):
+    # the errors are raised at the first attempt instead, the retries are up to the ProviderClient
+    def _get(self, url, args=None, payload=None, **kwargs):
+        if args:
+            kwargs.update(args)
+        return self._internal_call('GET', url, payload, kwargs)
+
+
+class _UnclosableConnection(object):
+    def close(self):
+        pass
+
+
+class _KeepAliveSessionProxy(httpsessions.SessionProxy):
+    # spotipy closes the connection of every response, that is the adapter of the session with all its pools
+    # (the ones used by the other threads too): the responses given to spotipy have a connection that cannot be
+    # closed, the sockets stay in the pool
+
+    def request(self, *args, **kwargs):
+        response = super(_KeepAliveSessionProxy, self).request(*args, **kwargs)
+        response.connection = _UnclosableConnection()
+        return response
+
+
 class Spotify(object):
     
     client_credentials_manager = None
     sp = None
+    # https://developer.spotify.com/web-api/get-several-tracks/
+    MAX_TRACKS_PER_REQUEST = 50
+    _tracks_memo = OrderedDict()  # track_id -> track, the least recently used are forgotten first
+    _tracks_memo_lock = threading.Lock()
+    client = ProviderClient('spotify', settings.SPOTIFY_RATE)
     
     @classmethod
     def authenticate(cls):
@@ -19,13 +56,26 @@ class Spotify(object):
             client_id=settings.BOT_SECRETS['spotify_client_id'],
             client_secret=settings.BOT_SECRETS['spotify_client_secret']
         )
-        cls.sp = spotipy.Spotify(client_credentials_manager=cls.client_credentials_manager)
+        cls.sp = _SingleAttemptSpotify(client_credentials_manager=cls.client_credentials_manager,
+                                 requests_session=_KeepAliveSessionProxy('spotify'))
+
+
+    @classmethod
+    def _call(cls, func, *args, **kwargs):
+        def attempt():
+            try:
+                return func(*args, **kwargs)
+            except spotipy.SpotifyException as e:
+                if e.http_status == 429:
+                    raise ProviderThrottledException(str(e), parse_retry_after(e.headers.get('Retry-After', None)))
+                raise
+        return cls.client.call(attempt)
 
 
     @classmethod
     def search(cls, query):
         
-        results = cls.sp.search(q=query, limit=10)
+        results = cls._call(cls.sp.search, q=query, limit=10)
         data = []
         for t in results['tracks']['items']:
             artists = []
@@ -41,6 +91,24 @@ class Spotify(object):
 
 
     @classmethod
-    def request_track(cls, track_id):
-        urn = 'spotify:track:' + track_id
-        return cls.sp.track(urn)
+    def request_tracks(cls, track_ids):
+        # returns a dict track_id -> track (None if spotify doesn't know the id). The tracks not requested yet are
+        # requested together, MAX_TRACKS_PER_REQUEST per request
+        tracks = { }
+        with cls._tracks_memo_lock:
+            for track_id in track_ids:
+                if track_id in cls._tracks_memo:
+                    tracks[track_id] = cls._tracks_memo.pop(track_id)
+                    cls._tracks_memo[track_id] = tracks[track_id]
+        
+        missing = list(OrderedDict.fromkeys(t for t in track_ids if t not in tracks))
+        for i in range(0, len(missing), cls.MAX_TRACKS_PER_REQUEST):
+            chunk = missing[i:i + cls.MAX_TRACKS_PER_REQUEST]
+            results = cls._call(cls.sp.tracks, ['spotify:track:' + track_id for track_id in chunk])['tracks']
+            with cls._tracks_memo_lock:
+                for track_id, track in zip(chunk, results):
+                    tracks[track_id] = track
+                    cls._tracks_memo[track_id] = track
+                while len(cls._tracks_memo) > settings.SPOTIFY_TRACKS_MEMO_SIZE:
+                    cls._tracks_memo.popitem(last=False)
+        return tracks
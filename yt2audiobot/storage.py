@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import os
+import glob
+import errno
+import logging
+import threading
+from collections import OrderedDict
+
+from yt2audiobot import utils
+from yt2audiobot import settings
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+
+def jobs_dir(directory):
+    # the subdirectory of directory where the jobs write their files: it belongs to the bot, directory can be
+    # shared (i.e. the tmpfs one)
+    return os.path.join(directory, settings.AUDIO_JOBS_DIR_NAME)
+
+
+def output_dirs():
+    # the directories where the jobs write their files: the tmpfs one (if any) first
+    dirs = [jobs_dir(settings.AUDIO_OUTPUT_DIR)]
+    if settings.AUDIO_TMPFS_DIR:
+        dirs.insert(0, jobs_dir(settings.AUDIO_TMPFS_DIR))
+    return dirs
+
+
+def _ensure_directory(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def free_space(directory):
+    stat = os.statvfs(directory)
+    return stat.f_bavail * stat.f_frsize
+
+
+def choose_output_dir(estimated_filesize):
+    # the tmpfs directory if it has room for the job (the downloaded source and the extracted audio, plus the
+    # reserve), otherwise the directory on disk. Called by the download processes
+    if settings.AUDIO_TMPFS_DIR:
+        tmpfs_dir = jobs_dir(settings.AUDIO_TMPFS_DIR)
+        required = 2 * (estimated_filesize or settings.MAX_AUDIO_FILE_SIZE) + settings.AUDIO_TMPFS_RESERVE
+        try:
+            _ensure_directory(tmpfs_dir)
+            if free_space(tmpfs_dir) >= required:
+                return tmpfs_dir
+            logger.info('[Storage] tmpfs is full (less than %s free): using the disk', utils.format_size(required))
+        except OSError as e:
+            logger.warning('[Storage] cannot use %s: %s', tmpfs_dir, e)
+    output_dir = jobs_dir(settings.AUDIO_OUTPUT_DIR)
+    _ensure_directory(output_dir)
+    return output_dir
+
+
+def job_files(youtube_id):
+    # every file a job of youtube_id can leave in the output directories: <id>.<ext> (the audio, the youtube_dl
+    # source and its .part) and <metadata>_<id>.<ext> (the renamed audio). The youtube_ids have no glob wildcards
+    files = []
+    for directory in output_dirs():
+        files += glob.glob(os.path.join(directory, youtube_id + '.*'))
+        files += glob.glob(os.path.join(directory, '*_' + youtube_id + '.*'))
+    return files
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            logger.warning('[Storage] cannot remove %s: %s', path, e)
+        return False
+
+
+class StorageManager(object):
+    # Lifecycle of the files in the output directories. When a job is over, its audio is either kept in the hot
+    # tier or deleted with every other file of the job. The hot tier keeps the audios of the last jobs (least
+    # recently used evicted beyond AUDIO_HOT_TIER_SIZE bytes) with their data: a request of a video not uploaded
+    # yet (i.e. the upload failed) gets the hot audio without downloading it again. The files in the jobs
+    # directories at startup are orphans of the previous run and are swept.
+
+    def __init__(self, max_size=settings.AUDIO_HOT_TIER_SIZE):
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._hot = OrderedDict()  # youtube_id -> (data of the job, file size)
+        self._size = 0
+
+
+    def sweep(self):
+        removed = 0
+        size = 0
+        for directory in output_dirs():
+            _ensure_directory(directory)
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isfile(path):
+                    file_size = os.path.getsize(path)
+                    if _remove(path):
+                        removed += 1
+                        size += file_size
+        with self._lock:
+            self._hot.clear()
+            self._size = 0
+        logger.info('[Storage] %d orphan files swept (%s)', removed, utils.format_size(size))
+
+
+    def keep(self, youtube_id, data):
+        # the job is over and data['filename'] is its audio: it goes to the hot tier, the other files are deleted
+        filename = data['filename']
+        for path in job_files(youtube_id):
+            if os.path.abspath(path) != os.path.abspath(filename):
+                _remove(path)
+        try:
+            file_size = os.path.getsize(filename)
+        except OSError:
+            return
+        if file_size > self._max_size:
+            _remove(filename)
+            return
+
+        evicted = []
+        with self._lock:
+            _, old_size = self._hot.pop(youtube_id, (None, 0))
+            self._size += file_size - old_size
+            self._hot[youtube_id] = (dict(data), file_size)
+            while self._size > self._max_size:
+                _, (evicted_data, evicted_size) = self._hot.popitem(last=False)
+                self._size -= evicted_size
+                evicted.append(evicted_data['filename'])
+        for path in evicted:
+            _remove(path)
+
+
+    def discard(self, youtube_id):
+        # the job is over without an audio to keep (failed, too large, ...): all its files are deleted
+        with self._lock:
+            _, file_size = self._hot.pop(youtube_id, (None, 0))
+            self._size -= file_size
+        for path in job_files(youtube_id):
+            _remove(path)
+
+
+    def hot(self, youtube_id):
+        # a copy of the data of the hot audio of youtube_id, None if there isn't
+        with self._lock:
+            entry = self._hot.pop(youtube_id, None)
+            if entry is None:
+                return None
+            if not os.path.exists(entry[0]['filename']):
+                self._size -= entry[1]
+                return None
+            self._hot[youtube_id] = entry
+            return dict(entry[0])
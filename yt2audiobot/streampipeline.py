@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import os
+import time
+import errno
+import logging
+import tempfile
+import subprocess
+
+import requests
+from youtube_dl.utils import format_bytes
+from youtube_dl.utils import determine_protocol
+from youtube_dl.downloader.common import FileDownloader
+
+from yt2audiobot import utils
+from yt2audiobot import settings
+from yt2audiobot import httpsessions
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+
+CHUNK_SIZE = 64 << 10
+STREAMABLE_PROTOCOLS = ['http', 'https']
+# codec of the output -> (ffmpeg encoder, ffmpeg muxer)
+FFMPEG_OUTPUTS = {
+    'mp3': ('libmp3lame', 'mp3'),
+    'm4a': ('aac', 'ipod'),
+}
+
+
+class StreamingNotSupported(Exception):
+    # the format cannot be streamed: it has to be downloaded by youtube_dl
+    pass
+
+
+class StreamingError(Exception):
+    pass
+
+
+def ffmpeg_command(output, filename):
+    if output.codec not in FFMPEG_OUTPUTS:
+        raise StreamingNotSupported('no ffmpeg output for %s' % output.codec)
+    encoder, muxer = FFMPEG_OUTPUTS[output.codec]
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-i', 'pipe:0', '-vn']
+    if output.passthrough:
+        command += ['-acodec', 'copy']
+    else:
+        command += ['-acodec', encoder, '-b:a', '%dk' % output.bitrate]
+    return command + ['-f', muxer, filename]
+
+
+def _progress(start, downloaded_bytes, total_bytes):
+    now = time.time()
+    hook = {
+        'status': 'downloading',
+        'downloaded_bytes': downloaded_bytes,
+        'total_bytes': total_bytes,
+        'elapsed': now - start,
+        '_speed_str': FileDownloader.format_speed(FileDownloader.calc_speed(start, now, downloaded_bytes)),
+    }
+    if total_bytes:
+        hook['_percent_str'] = FileDownloader.format_percent(100.0 * downloaded_bytes / total_bytes)
+        hook['_eta_str'] = FileDownloader.format_eta(FileDownloader.calc_eta(start, now, total_bytes, downloaded_bytes))
+    else:
+        hook['_percent_str'] = FileDownloader.format_percent(None)
+        hook['_eta_str'] = FileDownloader.format_eta(None)
+    return hook
+
+
+def _finished(start, filename, downloaded_bytes):
+    # the same hook youtube_dl sends at the end of the download, before the audio postprocess
+    return {
+        'status': 'finished',
+        'filename': filename,
+        'downloaded_bytes': downloaded_bytes,
+        'total_bytes': downloaded_bytes,
+        'elapsed': time.time() - start,
+        '_total_bytes_str': format_bytes(downloaded_bytes),
+    }
+
+
+def stream_and_extract_audio(audio_format, output, filename, progress_hook):
+    # Downloads the audio format (the format dict selected by youtube_dl) and pipes it, while it is still being
+    # downloaded, into ffmpeg, which writes the audio `output` (a codecpolicy.AudioOutput) to filename: only the
+    # output touches the disk. The file is written as filename.part and renamed once ffmpeg has succeeded.
+    if determine_protocol(audio_format) not in STREAMABLE_PROTOCOLS:
+        raise StreamingNotSupported('protocol %s' % determine_protocol(audio_format))
+    if output.passthrough and audio_format.get('ext', None) != output.codec:
+        raise StreamingNotSupported('%s cannot be passed through as %s' % (audio_format.get('ext', None), output.codec))
+
+    part_filename = filename + '.part'
+    command = ffmpeg_command(output, part_filename)
+    try:
+        response = httpsessions.get_session('youtube').get(audio_format['url'], stream=True,
+                                                           headers=audio_format.get('http_headers', None))
+    except requests.RequestException as e:
+        raise StreamingError('cannot download %s: %s' % (audio_format.get('format_id', None), e))
+    if response.status_code != 200:
+        response.close()
+        raise StreamingError('HTTP %d downloading %s' % (response.status_code, audio_format.get('format_id', None)))
+    total_bytes = int(response.headers.get('Content-Length', 0)) or audio_format.get('filesize', None)
+
+    stderr = tempfile.TemporaryFile()
+    try:
+        ffmpeg = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=stderr, stderr=stderr)
+    except OSError as e:
+        response.close()
+        stderr.close()
+        raise StreamingNotSupported('cannot run ffmpeg: %s' % e)
+
+    start = last_progress = time.time()
+    downloaded_bytes = 0
+    try:
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                ffmpeg.stdin.write(chunk)
+                downloaded_bytes += len(chunk)
+                if time.time() - last_progress >= settings.PROGRESS_UPDATE_INTERVAL:
+                    last_progress = time.time()
+                    progress_hook(_progress(start, downloaded_bytes, total_bytes))
+            ffmpeg.stdin.close()
+            progress_hook(_finished(start, filename, downloaded_bytes))
+        except IOError as e:
+            # EPIPE: ffmpeg has already exited, its error is reported below
+            if e.errno != errno.EPIPE:
+                ffmpeg.kill()
+                raise StreamingError('streaming interrupted after %d bytes: %s' % (downloaded_bytes, e))
+        except Exception as e:
+            ffmpeg.kill()
+            raise StreamingError('streaming interrupted after %d bytes: %s' % (downloaded_bytes, e))
+        finally:
+            response.close()
+
+        if ffmpeg.wait() != 0:
+            stderr.seek(0)
+            raise StreamingError('ffmpeg exited with %d: %s' %
+                                 (ffmpeg.returncode, stderr.read().decode('utf-8', 'replace').strip()))
+        if total_bytes and downloaded_bytes < total_bytes:
+            raise StreamingError('incomplete download: %d of %d bytes' % (downloaded_bytes, total_bytes))
+    except StreamingError:
+        ffmpeg.wait()
+        if os.path.exists(part_filename):
+            os.remove(part_filename)
+        raise
+    finally:
+        stderr.close()
+
+    os.rename(part_filename, filename)
+    logger.info('[Streaming] %s: %s downloaded and extracted in %.1fs',
+                filename, utils.format_size(downloaded_bytes), time.time() - start)
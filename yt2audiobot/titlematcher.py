@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import re
+import timeit
+
+from yt2audiobot import settings
+
+
+# the bad words are removed in a single pass, the longest first
+BAD_WORDS_REGEX = re.compile('|'.join(re.escape(w) for w in sorted(settings.BAD_WORDS, key=len, reverse=True)))
+
+
+def remove_bad_words(text):
+    return BAD_WORDS_REGEX.sub('', text)
+
+
+class TitleMatcher(object):
+    # Built once per title: tells if a text contains at least one of the title words as a whole word
+    # (case-insensitive), with a single precompiled alternation instead of a regex per word
+
+    def __init__(self, title_words):
+        # case-folded and deduplicated, the empty words are kept: like \b()\b they match any boundary
+        words = sorted(set(w.lower() for w in title_words), key=len, reverse=True)
+        self.words = words
+        self._regex = None
+        if len(words) > 0:
+            self._regex = re.compile(r'\b(?:{0})\b'.format('|'.join(re.escape(w) for w in words)),
+                                     flags=re.IGNORECASE)
+
+
+    def matches(self, text):
+        return self._regex is not None and self._regex.search(text) is not None
+
+
+    def matches_all(self, *texts):
+        return all(self.matches(text) for text in texts)
+
+
+if __name__ == '__main__':
+    # micro-benchmark against the former search_in_text/remove_bad_word, with a regex per word: a title matched
+    # against a page of 10 musixmatch and 10 spotify candidates, each candidate checked on the track name and on
+    # the artist
+
+    def remove_bad_word(text):
+        for word in settings.BAD_WORDS:
+            text = text.replace(word, '')
+        return text
+
+    # thanks to: http://stackoverflow.com/a/5320179
+    def find_whole_word(w, text):
+        return re.compile(r'\b({0})\b'.format(w), flags=re.IGNORECASE).search(text)
+
+    def search_in_text(word_list, text):
+        for w in word_list:
+            if find_whole_word(w, text):
+                return True
+        return False
+
+    title = 'Imagine Dragons - Believer (Official Music Video) [HD] ft Someone'
+    candidates = [('Believer', 'Imagine Dragons'), ('Thunder', 'Imagine Dragons'), ('Believer', 'Kanye West'),
+                  ('Radioactive', 'Imagine Dragons'), ('Believer (Remix)', 'Lil Wayne'), ('Demons', 'Someone'),
+                  ('Whatever It Takes', 'Imagine Dragons'), ('Natural', 'Imagine Dragons'),
+                  ('Believe', 'Cher'), ('Believer - Acoustic', 'Imagine Dragons')] * 2
+
+    def baseline():
+        words = [w for w in remove_bad_word(title).split(' ') if w != '']
+        return [c for c in candidates
+                if search_in_text(words, c[0]) and search_in_text(words, c[1])]
+
+    def compiled():
+        matcher = TitleMatcher(w for w in remove_bad_words(title).split(' ') if w != '')
+        return [c for c in candidates if matcher.matches_all(c[0], c[1])]
+
+    assert baseline() == compiled()
+    for text in ['Jay-Z', 'C++ (Live)', 'a.b', '', 'Beyoncé', 'ft. Someone']:
+        words = [w for w in remove_bad_words(text).split(' ') if w != '']
+        if any(c in '.^$*+?{}[]\\|()' for w in words for c in w):
+            continue  # search_in_text doesn't escape the words: they are used as regular expressions
+        for other in ['Jay-Z', 'Beyoncé', 'ab', 'axb', 'c', 'someone else']:
+            assert search_in_text(words, other) == TitleMatcher(words).matches(other), (text, other)
+
+    number = 2000
+    baseline_time = timeit.timeit(baseline, number=number)
+    compiled_time = timeit.timeit(compiled, number=number)
+    print('search_in_text: %.1f us/title' % (baseline_time * 1e6 / number))
+    print('TitleMatcher:   %.1f us/title (x%.1f)' % (compiled_time * 1e6 / number, baseline_time / compiled_time))
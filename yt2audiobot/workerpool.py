@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import sys
+import time
+import logging
+import threading
+from collections import deque
+
+import six
+from six.moves import queue
+
+from yt2audiobot import settings
+
+
+logger = logging.getLogger(settings.BOT_NAME)
+
+
+_STOP = object()
+
+
+class ChatOrderedWorkerPool(object):
+    # A bounded pool of worker threads. Tasks put with different keys (chat ids) run in parallel,
+    # while tasks with the same key are executed one at a time in the order they were put.
+    # It exposes the same exception interface of telebot.util.ThreadPool because the threaded
+    # polling of TeleBot relies on it (exception_event, raise_exceptions, clear_exceptions).
+
+    def __init__(self, num_threads=settings.WORKER_POOL_SIZE):
+        if num_threads < 1:
+            raise ValueError('num_threads must be at least 1')
+        self.num_threads = num_threads
+        self.exception_event = threading.Event()
+        self.exc_info = None
+
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = {}  # key -> deque of (task, args, kwargs) not executed yet
+        self._ready = queue.Queue()  # keys having pending tasks and not taken by any worker
+        self._workers = []
+        for i in range(num_threads):
+            worker = threading.Thread(target=self._run, name='ChatWorker-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+
+    def put(self, key, task, *args, **kwargs):
+        with self._lock:
+            tasks = self._pending.get(key)
+            if tasks is not None:
+                # the key is already scheduled or running: the worker will pick up this task later
+                tasks.append((task, args, kwargs))
+                return
+            self._pending[key] = deque([(task, args, kwargs)])
+        self._ready.put(key)
+
+
+    def _run(self):
+        while True:
+            key = self._ready.get()
+            if key is _STOP:
+                return
+
+            with self._lock:
+                task, args, kwargs = self._pending[key].popleft()
+
+            try:
+                task(*args, **kwargs)
+            except Exception:
+                logger.error('Unhandled exception in worker pool (key: %s)', key)
+                self.on_exception(sys.exc_info())
+
+            with self._lock:
+                if not self._pending[key]:
+                    del self._pending[key]
+                    if not self._pending:
+                        self._idle.notify_all()
+                    continue
+            # other tasks of the same key are waiting: requeue it behind the other keys to be fair
+            self._ready.put(key)
+
+
+    def on_exception(self, exc_info):
+        self.exc_info = exc_info
+        self.exception_event.set()
+
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            six.reraise(self.exc_info[0], self.exc_info[1], self.exc_info[2])
+
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+
+    def wait_completion(self):
+        with self._idle:
+            while self._pending:
+                self._idle.wait()
+
+
+    def close(self):
+        self.wait_completion()
+        for _ in self._workers:
+            self._ready.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+
+
+if __name__ == '__main__':
+    # stress test against a fake Telegram API: every update of a chat does a few blocking calls.
+    # Throughput must scale with the pool size and the updates of each chat must keep their order.
+
+    class FakeTelegramApi(object):
+        def __init__(self, latency):
+            self._latency = latency
+            self._lock = threading.Lock()
+            self.sent = { }
+
+
+        def send_message(self, chat_id, text):
+            time.sleep(self._latency)
+            with self._lock:
+                self.sent.setdefault(chat_id, []).append(text)
+
+
+    def handle_update(api, chat_id, update_id):
+        for _ in range(3):
+            api.send_message(chat_id, update_id)
+
+
+    chats = 16
+    updates_per_chat = 5
+    baseline = None
+    for pool_size in [1, 2, 4, 8, 16]:
+        api = FakeTelegramApi(latency=0.005)
+        pool = ChatOrderedWorkerPool(pool_size)
+        start = time.time()
+        for update_id in range(updates_per_chat):
+            for chat_id in range(chats):
+                pool.put(chat_id, handle_update, api, chat_id, update_id)
+        pool.close()
+        elapsed = time.time() - start
+
+        for chat_id in range(chats):
+            expected = [update_id for update_id in range(updates_per_chat) for _ in range(3)]
+            assert api.sent[chat_id] == expected, 'chat %d out of order: %s' % (chat_id, api.sent[chat_id])
+
+        throughput = chats * updates_per_chat / elapsed
+        baseline = baseline or throughput
+        print('pool size: %2d - %7.1f updates/s - speedup x%.1f' % (pool_size, throughput, throughput / baseline))
@@ -1,15 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from __future__ import unicode_literals, absolute_import
+from __future__ import print_function, unicode_literals, absolute_import
 
 import os
+import re
+import copy
 import logging
-import requests
 import youtube_dl as ytdl
+from six.moves.urllib.parse import urlparse, parse_qs
 
 from yt2audiobot import utils
+from yt2audiobot import storage
 from yt2audiobot import settings
+from yt2audiobot.covercache import CoverCache
+from yt2audiobot import codecpolicy
+from yt2audiobot import streampipeline
 from yt2audiobot import metadatahelper
 
 
@@ -32,14 +38,52 @@ logger = logging.getLogger(settings.BOT_NAME)
 #     'extractor'
 # }
 
+YOUTUBE_ID_REGEX = re.compile(r'^[0-9A-Za-z_-]{11}$')
+YOUTUBE_HOSTS = ['youtube.com', 'www.youtube.com', 'm.youtube.com']
+YOUTU_BE_HOSTS = ['youtu.be', 'www.youtu.be']
+
+
+def youtube_id_from_url(url):
+    # maps the urls of a single video (youtu.be/<id>, /embed/<id>, /v/<id> and /watch?v=<id>) to the youtube_id
+    # without any request to youtube. Playlists and the other urls return None: they need extract_info
+    if not re.match(r'^https?://', url, flags=re.IGNORECASE):
+        url = 'http://' + url
+    parsed = urlparse(url)
+    host = parsed.netloc.lower().split(':')[0]
+    query = parse_qs(parsed.query)
+    if 'list' in query:
+        return None
+    
+    path = parsed.path.split('/')
+    if host in YOUTU_BE_HOSTS:
+        candidate = path[1] if len(path) > 1 else None
+    elif host in YOUTUBE_HOSTS and parsed.path == '/watch':
+        candidate = query.get('v', [None])[0]
+    elif host in YOUTUBE_HOSTS and len(path) > 2 and path[1] in ['embed', 'v']:
+        candidate = path[2]
+    else:
+        return None
+    
+    if candidate is not None and YOUTUBE_ID_REGEX.match(candidate):
+        return candidate
+    return None
+
+
 def init_spotify():
     metadatahelper.spotifyhelper.Spotify.authenticate()
 
 
+_cover_cache = CoverCache()
+
+
 class FileIsTooLargeException(ValueError):
     pass
 
 
+class VideoIsTooLongException(ValueError):
+    pass
+
+
 class DownloadError(ValueError):
     pass
 
@@ -69,13 +113,13 @@ class YoutubeVideo(object):
     
     def __init__(self, video_id, info, progress_hook):
         self._DOWNLOAD_VIDEO_AND_EXTRACT_AUDIO = {
-            'outtmpl': settings.OUTPUT_FORMAT,
-            'format': 'bestaudio/best',
+            'outtmpl': os.path.join(storage.jobs_dir(settings.AUDIO_OUTPUT_DIR), settings.OUTPUT_TEMPLATE),
+            'format': codecpolicy.audio_format_selector(),
             'socket_timeout': 10,
             'postprocessors': [{
                 'key': 'FFmpegExtractAudio',
                 'preferredcodec': settings.PREFERRED_AUDIO_CODEC,
-                'preferredquality': '192',
+                'preferredquality': str(settings.AUDIO_QUALITIES[0]),
             }],
             'retries': 10,
             'logger': YoutubeDLLogger(),
@@ -86,6 +130,8 @@ class YoutubeVideo(object):
         self._video_id = video_id
         self._info = info
         self._progress_hook = progress_hook
+        self._output = codecpolicy.encoded_output(settings.AUDIO_QUALITIES[0])
+        self._output_dir = storage.jobs_dir(settings.AUDIO_OUTPUT_DIR)
     
     
     def _private_progress_hook(self, hook):
@@ -96,6 +142,10 @@ class YoutubeVideo(object):
         return self.YOUTUBE_WATCH_URL % self._video_id
     
     
+    def get_info(self):
+        return self._info
+    
+    
     def get_type(self):
         return self._info['extractor']
     
@@ -113,22 +163,76 @@ class YoutubeVideo(object):
     
     
     def download_thumbnail(self, index):
-        thumbnail = self.get_video_thumbnails()[index]
-        output = os.path.abspath(os.path.join(settings.AUDIO_OUTPUT_DIR, 'thumb_{0}'.format(self.get_youtube_id())))
+        # the cover made from the thumbnail (a covercache.Cover), None if it cannot be downloaded
+        return _cover_cache.get(self.get_video_thumbnails()[index])
+    
+    
+    def get_duration(self):
+        return self._info.get('duration', None)
+    
+    
+    def _get_best_audio_format(self):
+        # the same format chosen by codecpolicy.audio_format_selector: an audio only format if any (one that can
+        # be passed through first, with the original policy), otherwise the whole video
+        formats = [f for f in self._info.get('formats', None) or [] if f.get('vcodec', None) == 'none']
+        if len(formats) == 0:
+            return self._info
+        passthrough = [f for f in formats if codecpolicy.passthrough_output(f) is not None]
+        return max(passthrough or formats, key=lambda f: f.get('abr', None) or 0)
+    
+    
+    def estimate_audio_filesize(self, quality):
+        duration = self.get_duration()
+        if not duration:
+            audio_format = self._get_best_audio_format()
+            if audio_format.get('filesize', None) and audio_format.get('abr', None):
+                duration = audio_format['filesize'] * 8 / (audio_format['abr'] * 1000.0)
+        if not duration:
+            return None
+        return int(duration * quality * 1000 / 8)
+    
+    
+    def admit(self):
+        # rejects the videos that would be too long or too large before downloading them. If the preferred audio
+        # quality would make the file too large, a lower quality fitting the telegram limit is used instead
+        duration = self.get_duration()
+        if duration and duration > settings.LIMIT_VIDEO_DURATION:
+            raise VideoIsTooLongException(
+                'I am sorry. The video is too long: %d minutes, the limit is %d minutes.\n%s' %
+                (duration // 60, settings.LIMIT_VIDEO_DURATION // 60, self.get_url()))
         
-        r = requests.get(thumbnail, stream=True)
-        if r.status_code == 200:
-            with open(output, 'wb') as f:
-                for chunk in r:
-                    f.write(chunk)
+        # no encoding at all if the audio stream can be sent as it is
+        output = codecpolicy.passthrough_output(self._get_best_audio_format())
+        if output is not None and output.bitrate is not None:
+            estimated_filesize = self.estimate_audio_filesize(output.bitrate)
+            if estimated_filesize is None or estimated_filesize <= settings.MAX_AUDIO_FILE_SIZE:
+                self._set_output(output)
+                return estimated_filesize
+        # otherwise it is encoded, from the best audio stream
+        self._DOWNLOAD_VIDEO_AND_EXTRACT_AUDIO['format'] = 'bestaudio/best'
         
-        class Thumbnail(object):
-            def __init__(self, url, filename, mimetype):
-                self.url = url
-                self.filename = filename
-                self.mimetype = mimetype
+        for quality in settings.AUDIO_QUALITIES:
+            estimated_filesize = self.estimate_audio_filesize(quality)
+            if estimated_filesize is None or estimated_filesize <= settings.MAX_AUDIO_FILE_SIZE:
+                if quality != settings.AUDIO_QUALITIES[0]:
+                    logger.info('[Admission] %s rerouted to %dkbps', self.get_youtube_id(), quality)
+                self._set_output(codecpolicy.encoded_output(quality))
+                return estimated_filesize
         
-        return Thumbnail(thumbnail, output, r.headers['Content-Type'])
+        raise FileIsTooLargeException(self._file_is_too_large_message(estimated_filesize, 'estimated to be '))
+    
+    
+    def _set_output(self, output):
+        logger.debug('[Admission] %s served as %r', self.get_youtube_id(), output)
+        self._output = output
+        self._DOWNLOAD_VIDEO_AND_EXTRACT_AUDIO['postprocessors'][0]['preferredcodec'] = output.codec
+        self._DOWNLOAD_VIDEO_AND_EXTRACT_AUDIO['postprocessors'][0]['preferredquality'] = str(output.bitrate)
+    
+    
+    def _file_is_too_large_message(self, filesize, prefix=''):
+        return ('I am sorry. Telegram bots can currently send files of any type of up to 50 MB in size. '
+                'https://core.telegram.org/bots/faq#how-do-i-upload-a-large-file\n '
+                'This audio file is %s%s!' % (prefix, utils.format_size(filesize)))
     
     
     def is_part_of_playlist(self):
@@ -136,50 +240,115 @@ class YoutubeVideo(object):
     
     
     def _get_downloaded_file_abspath(self):
-        filename = self.get_youtube_id() + '.' + settings.PREFERRED_AUDIO_CODEC
-        return os.path.abspath(os.path.join(settings.AUDIO_OUTPUT_DIR, filename))
+        filename = self.get_youtube_id() + '.' + self._output.codec
+        return os.path.abspath(os.path.join(self._output_dir, filename))
+    
+    
+    def _download_and_extract_audio(self):
+        if settings.STREAMING_PIPELINE:
+            try:
+                self._stream_and_extract_audio()
+                return
+            except streampipeline.StreamingNotSupported as e:
+                logger.info('[Streaming] %s cannot be streamed (%s): downloading it', self.get_youtube_id(), e)
+            except streampipeline.StreamingError as e:
+                logger.warning('[Streaming] %s failed (%s): downloading it', self.get_youtube_id(), e)
+        
+        ydl = ytdl.YoutubeDL(self._DOWNLOAD_VIDEO_AND_EXTRACT_AUDIO)
+        ydl.download([self.get_url()])
     
     
-    def download_video_and_extract_audio(self):
+    def _stream_and_extract_audio(self):
+        # the format is chosen by youtube_dl, from the info already extracted: only its download is replaced
+        ydl = ytdl.YoutubeDL({
+            'format': self._DOWNLOAD_VIDEO_AND_EXTRACT_AUDIO['format'],
+            'logger': YoutubeDLLogger()
+        })
+        try:
+            audio_format = ydl.process_ie_result(copy.deepcopy(self._info), download=False)
+        except (ytdl.utils.DownloadError, ytdl.utils.ExtractorError) as e:
+            raise streampipeline.StreamingNotSupported(e)
+        streampipeline.stream_and_extract_audio(audio_format, self._output, self._get_downloaded_file_abspath(),
+                                                self._private_progress_hook)
+    
+    
+    def download_video_and_extract_audio(self, enrich=True):
+        # enrich=False skips the metadata search and the tags: the audio can be sent right away, its metadata are
+        # searched later with search_metadata
+        estimated_filesize = self.admit()
+        self._output_dir = storage.choose_output_dir(estimated_filesize)
+        self._DOWNLOAD_VIDEO_AND_EXTRACT_AUDIO['outtmpl'] = os.path.join(self._output_dir, settings.OUTPUT_TEMPLATE)
         logger.info('Starting download: %s (%s)', self.get_video_title(), self.get_url())
         try:
-            ydl = ytdl.YoutubeDL(self._DOWNLOAD_VIDEO_AND_EXTRACT_AUDIO)
-            ydl.download([self.get_url()])
-            
-            self._progress_hook({
-                'status': 'searching_metadata'
-            }, youtube_video=self)
-            
-            metadata = metadatahelper.metadata_from_title(self.get_video_title())
-            
-            logger.debug(self._get_downloaded_file_abspath())
-            logger.debug('{0}_{1}'.format(metadata.to_filename(), self.get_youtube_id()))
-            
-            filename = utils.rename_file(self._get_downloaded_file_abspath(),
-                                         '{0}_{1}'.format(metadata.to_filename(), self.get_youtube_id()))
-            
-            # if the extracted audio file is larger than 50M
-            filesize = os.path.getsize(filename)
-            if filesize >> 20 > 50:
-                raise FileIsTooLargeException(
-                    'I am sorry. Telegram bots can currently send files of any type of up to 50 MB in size. '
-                    'https://core.telegram.org/bots/faq#how-do-i-upload-a-large-file\n '
-                    'This audio file is %s!' % utils.format_size(filesize))
-
-            thumbnail = self.download_thumbnail(-1) if len(self.get_video_thumbnails()) > 0 else None
-            metadatahelper.write_metadata(metadata, filename, thumbnail)
-            os.remove(thumbnail.filename)
-            
-            return {
-                'title': metadata.title,
-                'author': metadata.author,
-                'album': metadata.album,
-                'track_number': metadata.track_number,
-                'first_release_date': metadata.first_release_date,
-                'filename': filename
-            }
+            self._download_and_extract_audio()
         except ytdl.utils.DownloadError as e:
             raise DownloadError('Failed downloading video: %s\n%s' % (self.__str__(), e))
+        
+        filename = self._get_downloaded_file_abspath()
+        filesize = os.path.getsize(filename)
+        if estimated_filesize is not None:
+            logger.info('[Admission] %s estimated: %s, actual: %s (error: %+.1f%%)', self.get_youtube_id(),
+                        utils.format_size(estimated_filesize), utils.format_size(filesize),
+                        (estimated_filesize - filesize) * 100.0 / filesize)
+        
+        # if the extracted audio file is larger than the telegram limit
+        if filesize > settings.MAX_AUDIO_FILE_SIZE:
+            raise FileIsTooLargeException(self._file_is_too_large_message(filesize))
+        
+        if enrich:
+            data = self.enrich_audio(filename)
+        else:
+            data = {
+                'title': self.get_video_title(),
+                'author': None,
+                'album': None,
+                'track_number': 0,
+                'first_release_date': None,
+                'filename': filename,
+                'enriched': False
+            }
+        data['estimated_file_size'] = estimated_filesize
+        data['codec'], data['bitrate'] = codecpolicy.probe(data['filename'])
+        return data
+    
+    
+    def search_metadata(self):
+        # only the metadata of the audio, for the db: an audio already sent is not tagged anymore
+        metadata = metadatahelper.metadata_from_title(self.get_video_title())
+        return {
+            'title': metadata.title,
+            'author': metadata.author,
+            'album': metadata.album,
+            'track_number': metadata.track_number,
+            'first_release_date': metadata.first_release_date
+        }
+    
+    
+    def enrich_audio(self, filename):
+        # searches the metadata of the audio, renames the file after them and writes its tags
+        self._progress_hook({
+            'status': 'searching_metadata'
+        }, youtube_video=self)
+        
+        metadata = metadatahelper.metadata_from_title(self.get_video_title())
+        
+        logger.debug(filename)
+        logger.debug('{0}_{1}'.format(metadata.to_filename(), self.get_youtube_id()))
+        
+        filename = utils.rename_file(filename, '{0}_{1}'.format(metadata.to_filename(), self.get_youtube_id()))
+        
+        thumbnail = self.download_thumbnail(-1) if len(self.get_video_thumbnails()) > 0 else None
+        metadatahelper.write_metadata(metadata, filename, thumbnail)
+        
+        return {
+            'title': metadata.title,
+            'author': metadata.author,
+            'album': metadata.album,
+            'track_number': metadata.track_number,
+            'first_release_date': metadata.first_release_date,
+            'filename': filename,
+            'enriched': True
+        }
 
 
 class YTHelper(object):
@@ -252,3 +421,5 @@ if __name__ == '__main__':
         'https://www.youube.com/watch?v=qy1Fzem7mqA',
         'https://www.youtube.com/playlist?list=PL5jc9xFGsL8E12so1wlMS0r0hTQoJL74M',
     ]
+    for link in links:
+        print('%s -> %s' % (link, youtube_id_from_url(link)))